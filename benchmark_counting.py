@@ -0,0 +1,121 @@
+"""Benchmark of the on device counting stage in mosquitocount.py.
+
+Counts synthetic trap pictures (see synthetic_trap()) of the size the
+camera takes and prints the time of each step, the total and how many
+of the mosquitoes were found. Run it on the pi, on a single core the
+median total should stay within --budget seconds; the exit status is
+1 when it does not.
+"""
+import argparse
+import sys
+import time
+
+import numpy
+
+import mosquitocount
+
+parser = argparse.ArgumentParser(description='Time count_mosquitoes() on synthetic trap pictures')
+parser.add_argument('--width', type=int, default=2592, help='Picture width')
+parser.add_argument('--height', type=int, default=1944, help='Picture height')
+parser.add_argument('--mosquitoes', type=int, default=60, help='Mosquitoes per picture')
+parser.add_argument('--runs', type=int, default=5, help='Pictures to count, the median is reported')
+parser.add_argument('--budget', type=float, default=5.0, help='Seconds the median count may take')
+parser.add_argument('--scaling', action='store_true',
+                    help='Time count_mosquitoes_tiled() with 1, 2 and 4 workers instead')
+parser.add_argument('--classifier', nargs='?', const='', default=None, metavar='MODEL',
+                    help='Time blob_features() and classify_blobs() instead, with the model '
+                         'saved by train_classifier.py or a random one with --hidden units')
+parser.add_argument('--hidden', type=int, default=16, help='Hidden units of the random model')
+
+def scaling(args):
+    """Median time of the tiled count for 1, 2 and 4 workers, next to
+    the single process count, and whether the counts agree.
+    """
+    pictures = [mosquitocount.synthetic_trap((args.height, args.width), args.mosquitoes, seed=run)[0]
+                for run in range(args.runs)]
+    base = []
+    counts = []
+    for y in pictures:
+        timings = {}
+        counts.append(mosquitocount.count_mosquitoes(y, timings=timings)[0])
+        base.append(sum(timings.values()))
+    print('single process  median %.3f s' % median(base))
+    for workers in (1, 2, 4):
+        totals = []
+        same = True
+        for y, count in zip(pictures, counts):
+            t0 = time.time()
+            tiled = mosquitocount.count_mosquitoes_tiled(y, workers=workers)[0]
+            totals.append(time.time() - t0)
+            same = same and tiled == count
+        print('%d worker(s)     median %.3f s, speedup %.2fx, counts %s'
+              % (workers, median(totals), median(base) / median(totals),
+                 'match' if same else 'DIFFER'))
+
+def random_model(features, hidden, seed=0):
+    """A model of the shape train_classifier.py saves, random weights."""
+    rng = numpy.random.RandomState(seed)
+    sizes = [features] + ([hidden] if hidden else []) + [1]
+    model = {'mean': numpy.zeros(features, dtype=numpy.float32),
+             'scale': numpy.ones(features, dtype=numpy.float32),
+             'threshold': numpy.array(0.5)}
+    for k, (n_in, n_out) in enumerate(zip(sizes[:-1], sizes[1:])):
+        model['w%d' % k] = (rng.randn(n_in, n_out) / numpy.sqrt(n_in)).astype(numpy.float32)
+        model['b%d' % k] = numpy.zeros(n_out, dtype=numpy.float32)
+    return model
+
+def classifier(args):
+    """Median time of the second stage on the blobs of each picture."""
+    model = None
+    if args.classifier:
+        model = mosquitocount.load_classifier(args.classifier)
+        if model is None:
+            print('no model in %s' % args.classifier)
+            sys.exit(1)
+    features, scores, blobs = [], [], []
+    for run in range(args.runs):
+        y = mosquitocount.synthetic_trap((args.height, args.width), args.mosquitoes, seed=run)[0]
+        found = mosquitocount.count_mosquitoes(y)[1]
+        t0 = time.time()
+        rows = mosquitocount.blob_features(y, found)
+        t1 = time.time()
+        if model is None:
+            model = random_model(rows.shape[1], args.hidden)
+        mosquitocount.classify_blobs(rows, model)
+        features.append(t1 - t0)
+        scores.append(time.time() - t1)
+        blobs.append(len(rows))
+    print('%d blobs per picture, %d layer model' % (median(blobs), len([k for k in model if k[0] == 'w'])))
+    print('features     median %.2f ms' % (median(features) * 1e3))
+    print('scoring      median %.2f ms' % (median(scores) * 1e3))
+    print('per blob     %.1f us' % ((median(features) + median(scores)) * 1e6 / max(median(blobs), 1)))
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.scaling:
+        scaling(args)
+        sys.exit(0)
+    if args.classifier is not None:
+        classifier(args)
+        sys.exit(0)
+    totals = []
+    steps = {}
+    for run in range(args.runs):
+        y, truth = mosquitocount.synthetic_trap((args.height, args.width), args.mosquitoes, seed=run)
+        timings = {}
+        count, blobs = mosquitocount.count_mosquitoes(y, timings=timings)
+        totals.append(sum(timings.values()))
+        for step, seconds in timings.items():
+            steps.setdefault(step, []).append(seconds)
+        print('picture %d: %d of %d mosquitoes counted in %.3f s' % (run, count, truth, totals[-1]))
+    for step in ('flat field', 'threshold', 'labelling', 'filters'):
+        print('%-12s median %.3f s' % (step, median(steps[step])))
+    print('%-12s median %.3f s for %dx%d' % ('total', median(totals), args.width, args.height))
+    if median(totals) > args.budget:
+        print('counting is over the %.1f s budget' % args.budget)
+        sys.exit(1)
+    print('counting is within the %.1f s budget' % args.budget)
@@ -0,0 +1,59 @@
+"""works only on python 2
+
+Startup benchmark for the debug mode exit path of
+raspberry_system_prototpye5_with_mopi.py.
+
+Run it on the pi with pin 26 connected to ground (debug mode).
+It runs the program a few times, prints how long the import of the
+program and the whole debug mode run took, and exits with status 1
+when the median run is over the time budget, or when a run fails.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+parser = argparse.ArgumentParser(description='Time the debug mode exit path')
+parser.add_argument('--script', default=os.path.join(here, 'raspberry_system_prototpye5_with_mopi.py'),
+                    help='Program to time')
+parser.add_argument('--runs', type=int, default=5,
+                    help='Number of runs, the median is reported')
+parser.add_argument('--budget', type=float, default=2.5,
+                    help='Seconds the median debug mode run may take')
+
+def timed_run(command, cwd):
+    """Run command, return its wall time in seconds.
+    Exit with status 1 when it fails, a crash is no startup time.
+    """
+    with open(os.devnull, 'w') as devnull:
+        t0 = time.time()
+        proc = subprocess.Popen(command, cwd=cwd, stdout=devnull, stderr=subprocess.PIPE)
+        err = proc.communicate()[1]
+        elapsed = time.time() - t0
+    if proc.returncode != 0:
+        print('%s exited with status %d' % (' '.join(command), proc.returncode))
+        sys.stdout.write(err.decode('utf8', 'replace'))
+        sys.exit(1)
+    return elapsed
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    cwd = os.path.dirname(os.path.abspath(args.script))
+    module = os.path.splitext(os.path.basename(args.script))[0]
+
+    imports = [timed_run([sys.executable, '-c', 'import ' + module], cwd)
+               for run in range(args.runs)]
+    print('import only: median %.3f s, min %.3f s' % (median(imports), min(imports)))
+    runs = [timed_run([sys.executable, args.script], cwd) for run in range(args.runs)]
+    print('debug mode exit: median %.3f s, min %.3f s' % (median(runs), min(runs)))
+
+    if median(runs) > args.budget:
+        print('debug mode exit is over the %.2f s budget' % args.budget)
+        sys.exit(1)
+    print('debug mode exit is within the %.2f s budget' % args.budget)
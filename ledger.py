@@ -0,0 +1,157 @@
+"""Append only ledger of the pictures, fixed width binary records.
+
+Takes the place of the text datafile, which was read whole and written
+again on every wake. Every record has the same size, so the last one
+is found from the file size alone: it is read and updated in place
+through mmap, and a new picture is one record appended at the end.
+A wake writes one page or one record to the sd card, however long the
+trap has been running.
+
+record: index, picture name (48 bytes, empty when no jpeg was kept),
+count, new arrivals, uploaded, reboots, time taken, time last updated
+(unix seconds)
+
+functions present:
+Ledger #the ledger file, last(), update_last(), append()
+is_ledger() #tells a ledger from a text datafile
+"""
+from collections import namedtuple
+import mmap
+import os
+import struct
+import time
+
+Record = namedtuple('Record', 'index name count new uploaded reboots taken updated')
+record_struct = struct.Struct('<I48siiBBxxdd')
+header_struct = struct.Struct('<8sI4x') #magic, record size
+magic = b'MOSLEDG1'
+name_size = 48
+
+def is_ledger(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(magic)) == magic
+    except IOError:
+        return False
+
+class Ledger(object):
+    """The records of a ledger file, made with just the header when
+    path does not exist. readonly opens it without any writing, to
+    read a copy from the Dropbox mirror.
+    """
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        if not readonly and not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(header_struct.pack(magic, record_struct.size))
+                f.flush()
+                os.fsync(f.fileno())
+        self.file = open(path, 'rb' if readonly else 'r+b')
+        found, size = header_struct.unpack(self.file.read(header_struct.size))
+        if found != magic or size != record_struct.size:
+            self.file.close()
+            raise ValueError('%s is not a ledger of %d byte records' % (path, record_struct.size))
+        end = os.fstat(self.file.fileno()).st_size
+        self.count = (end - header_struct.size) // record_struct.size
+        if not readonly and end != self.offset(self.count):
+            #a power cut during an append left half a record
+            self.file.truncate(self.offset(self.count))
+        self.map = None
+        self.remap()
+
+    def offset(self, i):
+        return header_struct.size + i * record_struct.size
+
+    def remap(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.count:
+            access = mmap.ACCESS_READ if self.readonly else mmap.ACCESS_WRITE
+            self.map = mmap.mmap(self.file.fileno(), self.offset(self.count), access=access)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError('ledger record %d of %d' % (i, self.count))
+        fields = record_struct.unpack_from(self.map, self.offset(i))
+        return Record(fields[0], fields[1].rstrip(b'\0').decode('utf-8'), *fields[2:])
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+    def last(self):
+        """The last record, None when there is none."""
+        return self[-1] if self.count else None
+
+    def pack(self, record):
+        name = record.name.encode('utf-8')
+        if len(name) > name_size:
+            raise ValueError('picture name longer than %d bytes: %s' % (name_size, record.name))
+        return record_struct.pack(record.index, name, *record[2:])
+
+    def update_last(self, **fields):
+        """Change fields of the last record in place, only its page is written."""
+        record = self.last()._replace(updated=time.time(), **fields)
+        at = self.offset(self.count - 1)
+        self.map[at:at + record_struct.size] = self.pack(record)
+        start = at - at % mmap.PAGESIZE
+        self.map.flush(start, at + record_struct.size - start)
+        return record
+
+    def append(self, index, name, count=-1, new=-1, uploaded=0, reboots=0, taken=None):
+        """Add a record at the end of the file, nothing before it is written."""
+        now = time.time()
+        record = Record(index, name, count, new, uploaded, reboots,
+                        now if taken is None else taken, now)
+        self.file.seek(self.offset(self.count))
+        self.file.write(self.pack(record))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.count += 1
+        self.remap()
+        return record
+
+    def import_text(self, path):
+        """Append the lines of a text datafile, both the
+        index , name , uploaded , reboots lines and the
+        index , name , count , new , uploaded , reboots ones.
+        """
+        with open(path, 'r') as f:
+            lines = f.readlines()
+        taken = os.path.getmtime(path)
+        records = []
+        for line in lines:
+            fields = [field.strip() for field in line.split(',')]
+            if len(fields) not in (4, 6) or not fields[0].isdigit():
+                continue
+            count, new = (int(fields[2]), int(fields[3])) if len(fields) == 6 else (-1, -1)
+            records.append(self.pack(Record(int(fields[0]), fields[1], count, new,
+                                            min(int(fields[-2]), 255), min(int(fields[-1]), 255),
+                                            taken, taken)))
+        self.file.seek(self.offset(self.count))
+        self.file.write(b''.join(records))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.count += len(records)
+        self.remap()
+        return len(records)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,632 @@
+"""Mosquito counting for the mostrap pictures, numpy only.
+
+count_mosquitoes() takes the luminance plane of a picture of the
+sticky board and counts the mosquito shaped dark blobs on it.
+-flat field correction, takes out the lamp falloff
+-adaptive threshold against the local mean
+-connected component labelling, on runs of pixels, vectorised
+-size and shape filters on the blob moments
+
+functions present:
+count_mosquitoes() #the whole counting stage
+count_mosquitoes_tiled() #the same on overlapping tiles, one process per core
+count_new_arrivals() #only what appeared since the last pictures, against a small background
+track_blobs() #matches blobs with the ones of earlier pictures, first seen picture per blob
+blob_features() #shape, intensity moments and HOG-lite of every blob, for the classifier
+classify_blobs() #second stage, mosquito or not for every blob at once, see train_classifier.py
+frame_confidence() #how far the count of a frame can be trusted, from exposure, blur and ambiguous blobs
+flat_field()
+box_mean()
+dark_mask()
+find_runs()
+label_runs() #8 way connected components of the runs
+blob_stats() #area, centroid, moments, bounding box per blob
+read_luma() #decodes a jpeg to a luminance array, needs PIL
+synthetic_trap() #fake trap pictures for the benchmarks
+"""
+from collections import namedtuple
+import math
+import multiprocessing
+import time
+
+import numpy
+
+# block: flat field block size, window: adaptive threshold box size (pixels)
+# darkness: how much darker than the local mean a mosquito pixel is (fraction)
+# min_area/max_area: blob size in pixels, max_elongation: long/short axis
+# min_fill: blob area over bounding box area
+Params = namedtuple('Params', 'block window darkness min_area max_area max_elongation min_fill')
+default_params = Params(block=64, window=101, darkness=0.25, min_area=40,
+                        max_area=6000, max_elongation=5.0, min_fill=0.2)
+blob_fields = ('area', 'cx', 'cy', 'x0', 'y0', 'x1', 'y1', 'elongation', 'fill',
+               'darkness', 'vxx', 'vyy', 'vxy')
+
+def count_mosquitoes(y, params=default_params, timings=None):
+    """Count the mosquitoes in a luminance image.
+
+    Return (count, blobs) where blobs is a dict of numpy arrays, one
+    entry per kept blob, keyed by blob_fields. When timings is a dict
+    the seconds spent in each step are stored in it.
+    """
+    t = [time.time()]
+    def lap(step):
+        t.append(time.time())
+        if timings is not None:
+            timings[step] = t[-1] - t[-2]
+    norm = flat_field(y, params.block)
+    lap('flat field')
+    mask = dark_mask(norm, params.window, params.darkness)
+    lap('threshold')
+    rows, starts, ends = find_runs(mask)
+    labels, nblobs = label_runs(rows, starts, ends, mask.shape[1])
+    lap('labelling')
+    blobs = blob_stats(rows, starts, ends, labels, nblobs, norm)
+    keep = shape_filter(blobs, params)
+    blobs = select_blobs(blobs, keep)
+    lap('filters')
+    return int(keep.sum()), blobs
+
+def flat_field(y, block):
+    """y divided by its illumination, so the board comes out near 1.0.
+    The illumination is the mean of block x block tiles, bilinearly
+    blown back up to full size.
+    """
+    y = numpy.asarray(y, dtype=numpy.float32)
+    h, w = y.shape
+    block = max(1, min(block, h, w))
+    bh, bw = h // block, w // block
+    small = y[:bh * block, :bw * block].reshape(bh, block, bw, block).mean(axis=(1, 3))
+    background = resize_bilinear(small, block, h, w)
+    return y / numpy.maximum(background, 1.0)
+
+def resize_bilinear(small, block, h, w):
+    """Blow a grid of block means up to h x w, interpolating between block centres."""
+    def weights(n, size):
+        pos = numpy.clip((numpy.arange(n) + 0.5) / block - 0.5, 0, size - 1)
+        i0 = numpy.floor(pos).astype(numpy.intp)
+        i1 = numpy.minimum(i0 + 1, size - 1)
+        return i0, i1, (pos - i0).astype(numpy.float32)
+    r0, r1, fr = weights(h, small.shape[0])
+    c0, c1, fc = weights(w, small.shape[1])
+    rows = small[r0] * (1 - fr)[:, None] + small[r1] * fr[:, None]
+    return rows[:, c0] * (1 - fc) + rows[:, c1] * fc
+
+def box_mean(img, window):
+    """Mean over the window x window box around each pixel, edges
+    repeated. Two passes of cumulative sums, so the cost does not
+    depend on the window size.
+    """
+    r = window // 2
+    window = 2 * r + 1
+    padded = numpy.pad(img, r, mode='edge')
+    c = numpy.cumsum(padded, axis=0, dtype=numpy.float64)
+    c = numpy.concatenate([numpy.zeros((1, c.shape[1])), c])
+    rows = c[window:] - c[:-window]
+    c = numpy.cumsum(rows, axis=1)
+    c = numpy.concatenate([numpy.zeros((c.shape[0], 1)), c], axis=1)
+    return ((c[:, window:] - c[:, :-window]) / (window * window)).astype(numpy.float32)
+
+def dark_mask(norm, window, darkness):
+    """Pixels darker than their local mean by more than darkness."""
+    return norm < box_mean(norm, window) * (1.0 - darkness)
+
+def find_runs(mask):
+    """Horizontal runs of True pixels as (rows, starts, ends) arrays,
+    ends exclusive, in row major order.
+    """
+    h, w = mask.shape
+    padded = numpy.zeros((h, w + 2), dtype=numpy.int8)
+    padded[:, 1:-1] = mask
+    step = numpy.diff(padded, axis=1)
+    rows, starts = numpy.nonzero(step == 1)
+    ends = numpy.nonzero(step == -1)[1]
+    return rows, starts, ends
+
+def label_runs(rows, starts, ends, width):
+    """8 way connected components of the runs from find_runs().
+
+    Runs on the next row that touch a run are found with two binary
+    searches, then the run graph is merged by hooking roots onto the
+    smallest neighbouring root and jumping pointers until every edge
+    joins runs with the same root.
+    Return (label of each run numbered from 0, number of components).
+    """
+    n = len(rows)
+    if n == 0:
+        return numpy.zeros(0, dtype=numpy.intp), 0
+    stride = width + 2
+    start_key = rows * stride + starts
+    end_key = rows * stride + ends
+    #touching runs on the next row have end >= start and start <= end
+    lo = numpy.searchsorted(end_key, (rows + 1) * stride + starts, 'left')
+    hi = numpy.searchsorted(start_key, (rows + 1) * stride + ends, 'right')
+    counts = numpy.maximum(hi - lo, 0)
+    a = numpy.repeat(numpy.arange(n), counts)
+    b = lo[a] + numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    parent = numpy.arange(n)
+    while len(a):
+        pa = parent[a]
+        pb = parent[b]
+        joined = pa != pb
+        if not joined.any():
+            break
+        a, b, pa, pb = a[joined], b[joined], pa[joined], pb[joined]
+        numpy.minimum.at(parent, numpy.maximum(pa, pb), numpy.minimum(pa, pb))
+        while True:
+            grand = parent[parent]
+            if (grand == parent).all():
+                break
+            parent = grand
+    roots, labels = numpy.unique(parent, return_inverse=True)
+    return labels, len(roots)
+
+def sum_squares(n):
+    """0**2 + 1**2 + ... + n**2"""
+    return n * (n + 1) * (2 * n + 1) / 6.0
+
+def blob_stats(rows, starts, ends, labels, nblobs, norm=None):
+    """Area, centroid, second moments, bounding box, elongation, fill
+    and, with the flat fielded image, darkness of every component.
+    Everything is summed per run in closed form, then per blob with
+    bincount, without going back to the pixels.
+    """
+    length = (ends - starts).astype(numpy.float64)
+    s = starts.astype(numpy.float64)
+    e = ends.astype(numpy.float64)
+    r = rows.astype(numpy.float64)
+    sx = length * (s + e - 1) / 2
+    def total(weights):
+        return numpy.bincount(labels, weights, nblobs)
+    area = total(length)
+    cx = total(sx) / area
+    cy = total(r * length) / area
+    vxx = total(sum_squares(e - 1) - sum_squares(s - 1)) / area - cx * cx
+    vyy = total(r * r * length) / area - cy * cy
+    vxy = total(r * sx) / area - cx * cy
+    #eigenvalues of the covariance, plus the 1/12 spread of a single pixel
+    half_trace = (vxx + vyy) / 2
+    disc = numpy.sqrt(numpy.maximum(half_trace ** 2 - (vxx * vyy - vxy ** 2), 0))
+    elongation = numpy.sqrt((half_trace + disc + 1 / 12.0) /
+                            numpy.maximum(half_trace - disc + 1 / 12.0, 1 / 12.0))
+    x0 = numpy.full(nblobs, numpy.inf)
+    x1 = numpy.zeros(nblobs)
+    y0 = numpy.full(nblobs, numpy.inf)
+    y1 = numpy.zeros(nblobs)
+    numpy.minimum.at(x0, labels, s)
+    numpy.maximum.at(x1, labels, e)
+    numpy.minimum.at(y0, labels, r)
+    numpy.maximum.at(y1, labels, r + 1)
+    blobs = {'area': area, 'cx': cx, 'cy': cy, 'x0': x0, 'y0': y0, 'x1': x1, 'y1': y1,
+             'elongation': elongation, 'fill': area / ((x1 - x0) * (y1 - y0)),
+             'vxx': vxx, 'vyy': vyy, 'vxy': vxy}
+    if norm is not None:
+        #sum of norm over each run from a cumulative sum along the rows
+        c = numpy.zeros((norm.shape[0], norm.shape[1] + 1))
+        numpy.cumsum(norm, axis=1, out=c[:, 1:])
+        blobs['darkness'] = 1 - total(c[rows, ends] - c[rows, starts]) / area
+    else:
+        blobs['darkness'] = numpy.zeros(nblobs)
+    return blobs
+
+def shape_filter(blobs, params):
+    """True for the blobs with the size and shape of a mosquito."""
+    area = blobs['area']
+    return ((area >= params.min_area) & (area <= params.max_area) &
+            (blobs['elongation'] <= params.max_elongation) &
+            (blobs['fill'] >= params.min_fill))
+
+def select_blobs(blobs, keep):
+    return dict((key, value[keep]) for key, value in blobs.items())
+
+def tile_halo(params):
+    """Pixels each tile reaches past its core. Enough for the longest
+    blob the shape filter keeps, plus the threshold window, rounded up
+    to whole flat field blocks plus one, so the core of a tile sees
+    the same background and the same whole blobs as the full frame.
+    """
+    reach = math.sqrt(4 * params.max_area * params.max_elongation / math.pi)
+    halo = int(reach) + params.window // 2
+    return (halo + params.block - 1) // params.block * params.block + params.block
+
+def tile_grid(h, w, rows, cols, block):
+    """Core (y0, y1, x0, x1) of rows x cols tiles covering h x w, with
+    the inner seams on multiples of block.
+    """
+    def cuts(n, parts):
+        inner = [int(round(n * k / float(parts) / block)) * block for k in range(1, parts)]
+        return [0] + inner + [n]
+    ys = cuts(h, rows)
+    xs = cuts(w, cols)
+    return [(ys[i], ys[i + 1], xs[j], xs[j + 1])
+            for i in range(rows) for j in range(cols)
+            if ys[i] < ys[i + 1] and xs[j] < xs[j + 1]]
+
+_shared = {} #image shared with the tile workers, set by _init_worker()
+
+def _init_worker(raw, shape):
+    _shared['image'] = numpy.frombuffer(raw, dtype=numpy.uint8).reshape(shape)
+
+def _count_tile(job):
+    """Count one tile with its halo. Only blobs whose centroid falls in
+    the core are returned, in full frame coordinates, so a blob on a
+    seam is counted by exactly one tile.
+    """
+    core, halo, params = job
+    image = _shared['image']
+    y0, y1 = max(0, core[0] - halo), min(image.shape[0], core[1] + halo)
+    x0, x1 = max(0, core[2] - halo), min(image.shape[1], core[3] + halo)
+    blobs = count_mosquitoes(image[y0:y1, x0:x1], params)[1]
+    for key in ('cx', 'x0', 'x1'):
+        blobs[key] = blobs[key] + x0
+    for key in ('cy', 'y0', 'y1'):
+        blobs[key] = blobs[key] + y0
+    keep = ((blobs['cy'] >= core[0]) & (blobs['cy'] < core[1]) &
+            (blobs['cx'] >= core[2]) & (blobs['cx'] < core[3]))
+    return select_blobs(blobs, keep)
+
+def count_mosquitoes_tiled(y, params=default_params, workers=4, timings=None):
+    """count_mosquitoes() split over a pool of worker processes.
+
+    The frame is copied once into a shared memory array the workers
+    map without copying, then cut into about one tile per worker. Each
+    tile is counted with a halo of tile_halo() pixels and keeps only
+    the blobs centred in its own core, which merges the seams without
+    counting a blob twice. Return (count, blobs) like count_mosquitoes().
+    """
+    t0 = time.time()
+    y = numpy.ascontiguousarray(y, dtype=numpy.uint8)
+    h, w = y.shape
+    raw = multiprocessing.RawArray('B', h * w)
+    numpy.frombuffer(raw, dtype=numpy.uint8)[:] = y.ravel()
+    rows = int(math.floor(math.sqrt(workers)))
+    cols = int(math.ceil(workers / float(rows)))
+    if w < h:
+        rows, cols = cols, rows
+    halo = tile_halo(params)
+    jobs = [(core, halo, params) for core in tile_grid(h, w, rows, cols, params.block)]
+    pool = multiprocessing.Pool(workers, _init_worker, (raw, y.shape))
+    try:
+        t1 = time.time()
+        parts = pool.map(_count_tile, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    blobs = dict((key, numpy.concatenate([part[key] for part in parts]))
+                 for key in parts[0])
+    if timings is not None:
+        timings['pool setup'] = t1 - t0
+        timings['tiles'] = time.time() - t1
+    return len(blobs['area']), blobs
+
+def downscale(y, factor):
+    """Mean of factor x factor blocks, the partial blocks at the edges dropped."""
+    h, w = y.shape[0] // factor, y.shape[1] // factor
+    return y[:h * factor, :w * factor].reshape(h, factor, w, factor).mean(axis=(1, 3))
+
+def load_background(path):
+    """The stack of small frames saved by save_background(), or None."""
+    try:
+        with numpy.load(path) as saved:
+            return saved['frames'], int(saved['total'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+def save_background(path, frames, total):
+    with open(path, 'wb') as f:
+        numpy.savez_compressed(f, frames=frames, total=total)
+
+def count_new_arrivals(y, frames=None, params=default_params, factor=8, change=0.15,
+                       depth=5, reset_fraction=0.5):
+    """Count only the mosquitoes that arrived since the last pictures.
+
+    frames is the stack of the last depth pictures downscaled by
+    factor, as uint8. Their per pixel median, flat fielded, is the
+    reference background. Cells of this picture darker than the
+    reference by more than change are grown by one cell and grouped
+    into regions. Only those regions, with a margin for the threshold
+    window, are counted at full resolution; blobs centred in a changed
+    cell are the new arrivals.
+    Changed cells are then written into every frame of the stack, so
+    what was just counted is background from now on, and the picture
+    is pushed on the stack. Without frames, with frames of another
+    size or when more than reset_fraction of the cells changed (a new
+    board) everything is counted and the stack starts again.
+    Return (new count, new blobs, updated frames).
+    """
+    small = downscale(numpy.asarray(y, dtype=numpy.float32), factor)
+    cells = numpy.clip(small + 0.5, 0, 255).astype(numpy.uint8)
+    if frames is None or frames.shape[1:] != cells.shape:
+        count, blobs = count_mosquitoes(y, params)
+        return count, blobs, cells[None]
+    block = max(1, params.block // factor)
+    reference = flat_field(numpy.median(frames, axis=0), block)
+    changed = flat_field(small, block) < reference * (1.0 - change)
+    if changed.mean() > reset_fraction:
+        count, blobs = count_mosquitoes(y, params)
+        return count, blobs, cells[None]
+    grown = changed.copy()
+    grown[1:] |= changed[:-1]
+    grown[:-1] |= changed[1:]
+    grown[:, 1:] |= changed[:, :-1]
+    grown[:, :-1] |= changed[:, 1:]
+    rows, starts, ends = find_runs(grown)
+    labels, nregions = label_runs(rows, starts, ends, grown.shape[1])
+    parts = []
+    if nregions:
+        regions = blob_stats(rows, starts, ends, labels, nregions)
+        margin = params.window // 2 + factor
+        h, w = y.shape
+        for x0, x1, y0, y1 in zip(regions['x0'], regions['x1'], regions['y0'], regions['y1']):
+            cy0, cy1 = max(0, int(y0) * factor - margin), min(h, int(y1) * factor + margin)
+            cx0, cx1 = max(0, int(x0) * factor - margin), min(w, int(x1) * factor + margin)
+            blobs = count_mosquitoes(y[cy0:cy1, cx0:cx1], params)[1]
+            for key in ('cx', 'x0', 'x1'):
+                blobs[key] = blobs[key] + cx0
+            for key in ('cy', 'y0', 'y1'):
+                blobs[key] = blobs[key] + cy0
+            cell_y = numpy.minimum(blobs['cy'] // factor, grown.shape[0] - 1).astype(numpy.intp)
+            cell_x = numpy.minimum(blobs['cx'] // factor, grown.shape[1] - 1).astype(numpy.intp)
+            #a blob seen from two overlapping crops is kept by the region holding its centre
+            inside = ((blobs['cx'] >= x0 * factor) & (blobs['cx'] < x1 * factor) &
+                      (blobs['cy'] >= y0 * factor) & (blobs['cy'] < y1 * factor))
+            parts.append(select_blobs(blobs, grown[cell_y, cell_x] & inside))
+    if parts:
+        blobs = dict((key, numpy.concatenate([part[key] for part in parts])) for key in parts[0])
+    else:
+        blobs = dict((key, numpy.zeros(0)) for key in blob_fields)
+    frames = frames.copy()
+    frames[:, grown] = cells[grown]
+    frames = numpy.concatenate([frames, cells[None]])[-depth:]
+    return len(blobs['area']), blobs, frames
+
+track_fields = ('cx', 'cy', 'area', 'elongation', 'first', 'last')
+track_stride = 1 << 20 #cell key is row * track_stride + column
+
+def empty_tracks():
+    tracks = dict((key, numpy.zeros(0)) for key in track_fields)
+    for key in ('first', 'last', 'cell'):
+        tracks[key] = numpy.zeros(0, dtype=numpy.int64)
+    return tracks
+
+def load_tracks(path):
+    """The tracks saved by save_tracks(), or None."""
+    try:
+        with numpy.load(path) as saved:
+            return dict((key, saved[key]) for key in track_fields + ('cell',))
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+def save_tracks(path, tracks):
+    with open(path, 'wb') as f:
+        numpy.savez_compressed(f, **tracks)
+
+def track_blobs(blobs, index, tracks=None, radius=12.0, area_ratio=1.6, elongation_diff=1.5):
+    """Match the blobs of picture index with the tracks of earlier pictures.
+
+    tracks hold one mosquito each: centroid, area, elongation, the
+    first and last picture it was seen in, and its cell on a grid of
+    radius sized cells. They are kept sorted by cell, so the tracks
+    near a blob are found with a searchsorted in the 3x3 cells around
+    it and the cost grows with the blobs, not with the tracks.
+    A blob matches the nearest free track within radius pixels whose
+    area is within area_ratio and elongation within elongation_diff
+    of its own; the others start new tracks first seen in index.
+    Return (first seen picture of each blob, updated tracks).
+    """
+    if tracks is None:
+        tracks = empty_tracks()
+    n = len(blobs['area'])
+    first = numpy.zeros(n, dtype=numpy.int64)
+    if n == 0:
+        return first, tracks
+    cx, cy = blobs['cx'], blobs['cy']
+    gx = (cx // radius).astype(numpy.int64)
+    gy = (cy // radius).astype(numpy.int64)
+    keys = ((gy[:, None] + numpy.repeat([-1, 0, 1], 3)) * track_stride +
+            gx[:, None] + numpy.tile([-1, 0, 1], 3)).ravel()
+    lo = numpy.searchsorted(tracks['cell'], keys, 'left')
+    hi = numpy.searchsorted(tracks['cell'], keys, 'right')
+    found = hi - lo
+    blob = numpy.repeat(numpy.repeat(numpy.arange(n), 9), found)
+    track = (numpy.arange(found.sum()) - numpy.repeat(numpy.cumsum(found) - found, found) +
+             numpy.repeat(lo, found))
+    dist = (tracks['cx'][track] - cx[blob]) ** 2 + (tracks['cy'][track] - cy[blob]) ** 2
+    ratio = tracks['area'][track] / numpy.maximum(blobs['area'][blob], 1)
+    ok = ((dist <= radius * radius) & (ratio <= area_ratio) & (ratio >= 1.0 / area_ratio) &
+          (abs(tracks['elongation'][track] - blobs['elongation'][blob]) <= elongation_diff))
+    matched = numpy.full(n, -1, dtype=numpy.intp)
+    taken = set()
+    order = numpy.argsort(dist[ok], kind='mergesort')
+    for b, t in zip(blob[ok][order], track[ok][order]):
+        if matched[b] < 0 and t not in taken:
+            matched[b] = t
+            taken.add(t)
+    seen = matched >= 0
+    tracks = dict((key, value.copy()) for key, value in tracks.items())
+    tracks['last'][matched[seen]] = index
+    first[seen] = tracks['first'][matched[seen]]
+    first[~seen] = index
+    new = numpy.flatnonzero(~seen)
+    cell = gy[new] * track_stride + gx[new]
+    new, cell = new[numpy.argsort(cell)], numpy.sort(cell) #new tracks going in at one place stay sorted
+    at = numpy.searchsorted(tracks['cell'], cell)
+    values = {'cx': cx[new], 'cy': cy[new], 'area': blobs['area'][new],
+              'elongation': blobs['elongation'][new], 'first': first[new],
+              'last': first[new], 'cell': cell}
+    for key in values:
+        tracks[key] = numpy.insert(tracks[key], at, values[key])
+    return first, tracks
+
+crop_size = 16 #blob crops for the features are crop_size x crop_size samples
+
+def blob_crops(y, blobs, size=crop_size, pad=1.5):
+    """size x size nearest pixel samples of a square pad times the
+    bounding box of each blob, centred on it, for all blobs in one
+    gather. Return a float32 array (blobs, size, size).
+    """
+    side = numpy.maximum(blobs['x1'] - blobs['x0'], blobs['y1'] - blobs['y0']) * pad
+    steps = (numpy.arange(size) + 0.5) / size - 0.5
+    rows = numpy.floor(blobs['cy'][:, None] + side[:, None] * steps).astype(numpy.intp)
+    cols = numpy.floor(blobs['cx'][:, None] + side[:, None] * steps).astype(numpy.intp)
+    rows = numpy.clip(rows, 0, y.shape[0] - 1)
+    cols = numpy.clip(cols, 0, y.shape[1] - 1)
+    return y[rows[:, :, None], cols[:, None, :]].astype(numpy.float32)
+
+def hog_lite(crops, bins=8, cells=2):
+    """Gradient orientation histograms, bins unsigned orientations in
+    each of cells x cells quarters of the crops, weighted by gradient
+    magnitude and L2 normalised per crop.
+    """
+    n, size = crops.shape[:2]
+    gx = numpy.zeros_like(crops)
+    gy = numpy.zeros_like(crops)
+    gx[:, :, 1:-1] = crops[:, :, 2:] - crops[:, :, :-2]
+    gy[:, 1:-1] = crops[:, 2:] - crops[:, :-2]
+    magnitude = numpy.hypot(gx, gy)
+    angle = numpy.arctan2(gy, gx) % numpy.pi
+    orientation = numpy.minimum((angle * (bins / numpy.pi)).astype(numpy.intp), bins - 1)
+    cell = numpy.arange(size) * cells // size
+    index = ((cell[:, None] * cells + cell[None, :]) * bins)[None] + orientation
+    index += (numpy.arange(n) * (cells * cells * bins))[:, None, None]
+    hist = numpy.bincount(index.ravel(), magnitude.ravel(), n * cells * cells * bins)
+    hist = hist.reshape(n, cells * cells * bins)
+    return hist / numpy.maximum(numpy.sqrt((hist ** 2).sum(axis=1)), 1e-6)[:, None]
+
+def blob_features(y, blobs):
+    """One row of features per blob, for classify_blobs():
+    log area, elongation, fill, darkness and spread from the blob
+    moments, then contrast, skew, kurtosis and minimum of its crop
+    relative to the crop mean, then the HOG-lite of the crop.
+    """
+    crops = blob_crops(y, blobs)
+    n = len(crops)
+    rel = crops.reshape(n, -1) / numpy.maximum(crops.reshape(n, -1).mean(axis=1), 1)[:, None]
+    centred = rel - rel.mean(axis=1)[:, None]
+    std = numpy.sqrt((centred ** 2).mean(axis=1))
+    spread = numpy.sqrt(numpy.maximum(blobs['vxx'] + blobs['vyy'], 0) / numpy.maximum(blobs['area'], 1))
+    moments = numpy.column_stack([
+        numpy.log(numpy.maximum(blobs['area'], 1)), blobs['elongation'], blobs['fill'],
+        blobs['darkness'], spread, std,
+        (centred ** 3).mean(axis=1) / numpy.maximum(std ** 3, 1e-6),
+        (centred ** 4).mean(axis=1) / numpy.maximum(std ** 4, 1e-6),
+        rel.min(axis=1)])
+    return numpy.hstack([moments, hog_lite(rel.reshape(crops.shape))]).astype(numpy.float32)
+
+def load_classifier(path):
+    """The model saved by train_classifier.py, or None.
+    mean and scale standardise the features, w0, b0, w1, b1... are
+    the layers, relu between them, and threshold is the probability
+    from which a blob is a mosquito.
+    """
+    try:
+        with numpy.load(path) as saved:
+            return dict((key, saved[key]) for key in saved.files)
+    except (IOError, OSError, ValueError):
+        return None
+
+def classify_blobs(features, model):
+    """Probability that each blob is a mosquito, one matrix multiply
+    per layer for all the blobs together.
+    """
+    x = (features - model['mean']) / model['scale']
+    layer = 0
+    while 'w%d' % (layer + 1) in model:
+        x = numpy.maximum(x.dot(model['w%d' % layer]) + model['b%d' % layer], 0)
+        layer += 1
+    z = (x.dot(model['w%d' % layer]) + model['b%d' % layer]).ravel()
+    return 1 / (1 + numpy.exp(-numpy.clip(z, -30, 30)))
+
+def filter_blobs(y, blobs, model):
+    """The blobs the model takes for mosquitoes."""
+    if not len(blobs['area']):
+        return blobs
+    keep = classify_blobs(blob_features(y, blobs), model) >= float(model['threshold'])
+    return select_blobs(blobs, keep)
+
+def sharpness(y, factor=4):
+    """Variance of the laplacian of y downscaled by factor, which
+    averages the sensor noise away but keeps the mosquito edges,
+    over the squared mean so the exposure does not change it.
+    """
+    small = downscale(y, factor)
+    laplacian = (small[:-2, 1:-1] + small[2:, 1:-1] + small[1:-1, :-2] + small[1:-1, 2:]
+                 - 4 * small[1:-1, 1:-1])
+    return float(laplacian.var() / max(small.mean() ** 2, 1.0))
+
+def frame_confidence(y, blobs, params=default_params, reference=None, blur_fraction=0.5,
+                     clip_limit=0.02, dark_level=80, bright_level=235, margin=0.2, prior=5):
+    """How far the count of a frame can be trusted, from 0 to 1.
+
+    exposure: 1 down to 0 as the share of pixels clipped at either end
+    of the histogram goes up to clip_limit, or as the median level
+    goes below dark_level or above bright_level.
+    blur: sharpness() against reference, the sharpness of recent good
+    frames, 1 down to 0 below blur_fraction of it; 1 without reference.
+    ambiguity: share of the blobs within margin of one of the shape
+    filter limits or of the darkness threshold, counted against prior
+    blobs more so a single borderline blob does not decide.
+    Return (confidence, reason, sharpness), confidence the lowest of
+    the three and reason the one that set it: 'dark', 'bright',
+    'blur', 'ambiguous' or None when the frame is fine.
+    """
+    small = y[::4, ::4]
+    dark = numpy.count_nonzero(small <= 5) / float(small.size)
+    bright = numpy.count_nonzero(small >= 250) / float(small.size)
+    level = float(numpy.median(small))
+    exposure = max(0.0, min(1 - (dark + bright) / clip_limit, level / dark_level,
+                            (255 - level) / (255.0 - bright_level)))
+    too_dark = dark > bright if dark + bright else level < 128
+    sharp = sharpness(y)
+    blur = 1.0
+    if reference:
+        blur = min(1.0, sharp / (blur_fraction * reference))
+    area = blobs['area']
+    borderline = ((area < params.min_area * (1 + margin)) |
+                  (area > params.max_area * (1 - margin)) |
+                  (blobs['elongation'] > params.max_elongation * (1 - margin)) |
+                  (blobs['fill'] < params.min_fill * (1 + margin)) |
+                  (blobs['darkness'] < params.darkness * (1 + margin)))
+    ambiguity = 1 - numpy.count_nonzero(borderline) / float(len(area) + prior)
+    scores = [(exposure, 'dark' if too_dark else 'bright'), (blur, 'blur'),
+              (ambiguity, 'ambiguous')]
+    confidence, reason = min(scores)
+    return float(confidence), reason if confidence < 1 else None, sharp
+
+def read_luma(source):
+    """Decode a jpeg file name or file object to a uint8 luminance array. Needs PIL."""
+    from PIL import Image
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    return numpy.asarray(Image.open(source).convert('L'))
+
+def synthetic_trap(shape=(1944, 2592), count=60, seed=0):
+    """A fake picture of the board: lamp falloff, sensor noise and
+    count dark mosquito sized ellipses at random angles, on a jittered
+    grid so they do not touch. Return (uint8 luminance, count).
+    """
+    rng = numpy.random.RandomState(seed)
+    h, w = shape
+    yy, xx = numpy.mgrid[0:h, 0:w].astype(numpy.float32)
+    falloff = ((yy - h / 2.0) ** 2 + (xx - w / 2.0) ** 2) / ((h / 2.0) ** 2 + (w / 2.0) ** 2)
+    img = 210 * (1 - 0.4 * falloff)
+    cols = int(numpy.ceil(numpy.sqrt(count * w / float(h))))
+    rows = int(numpy.ceil(count / float(cols)))
+    cell_h, cell_w = h / float(rows), w / float(cols)
+    size = min(cell_h, cell_w)
+    for k in range(count):
+        cy = (k // cols + 0.5 + rng.uniform(-0.15, 0.15)) * cell_h
+        cx = (k % cols + 0.5 + rng.uniform(-0.15, 0.15)) * cell_w
+        length = min(rng.uniform(30, 60), size * 0.35)
+        width = length * rng.uniform(0.25, 0.4)
+        angle = rng.uniform(0, numpy.pi)
+        reach = int(length) + 2
+        y0, y1 = max(0, int(cy) - reach), min(h, int(cy) + reach)
+        x0, x1 = max(0, int(cx) - reach), min(w, int(cx) + reach)
+        dy = yy[y0:y1, x0:x1] - cy
+        dx = xx[y0:y1, x0:x1] - cx
+        u = dx * numpy.cos(angle) + dy * numpy.sin(angle)
+        v = -dx * numpy.sin(angle) + dy * numpy.cos(angle)
+        inside = (u / (length / 2)) ** 2 + (v / (width / 2)) ** 2 <= 1
+        img[y0:y1, x0:x1][inside] *= rng.uniform(0.25, 0.45)
+    img += rng.normal(0, 4, size=shape)
+    return numpy.clip(img, 0, 255).astype(numpy.uint8), count
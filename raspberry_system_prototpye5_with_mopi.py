@@ -20,13 +20,18 @@ checkmode() #run once to check for mode, operationmode = True or False
 takepicture()
 trygpio()
 checkwifi()
+calibrate_roi() #run by --calibrate-roi, finds the board and saves the capture region
+boot_pipeline() #checkwifi() and takepicture() at the same time
+capture_until_confident() #takes the picture again only when its count is not trusted
+count_picture() #counts the mosquitoes with mosquitocount.py, goes into the ledger
+write_health() #counts, voltage and timings of the wake, uploaded first on a marginal link
 mainsyncprogram() #the uploading/file sync sequence
+list_remote_tree() #recursive dropbox listing, only the delta since the saved cursor
 cutoffgpio() #run once within shutdown seq
 shutdownseq() #only happens in operationmode
 rebootseq() #only happens in operationmode
 
 """
-from picamera import PiCamera
 from time import sleep
 
 import RPi.GPIO as GPIO
@@ -34,35 +39,127 @@ import tty
 import argparse
 import contextlib
 import datetime
+import hashlib
+import json
 import os
-import six
 import sys
+import threading
 import time
 import unicodedata
 import datetime
-import pytz
-import urllib2
-#importing mopiapi
+import random
+import socket
+import Queue
+from collections import namedtuple
+#mopiapi, picamera, dropbox, pytz and six are imported where they are
+#first needed so debug mode does not pay for them
 sys.path.append("/pi/Desktop/")
-import mopiapi
 
 if sys.version.startswith('2'):
     input = raw_input
-import dropbox
-from dropbox.files import FileMetadata, FolderMetadata
 #setting up the variables used throughout the program
-camera = PiCamera() #camera variables
-camera.resolution = (2592,1994)##(64,64) ##
-camera.framerate = 5
+camera = None #camera variables, the PiCamera is made by get_camera()
+camera_resolution = (2592,1994)##(64,64) ##
+camera_framerate = 5
+roi_path = '/home/pi/Desktop/mostrap1pics/.roi' #board region saved by calibrate_roi()
+roi_margin = 0.02 #added around the board found by calibrate_roi()
+roi_reference_size = (640, 480) #reference frame size for calibrate_roi()
+dropbox = None #the dropbox module, set by load_dropbox()
+FileMetadata = None #dropbox.files classes, set by load_dropbox()
+FolderMetadata = None
+adaptive_settle = True #poll the camera gains instead of the fixed sleeps in takepicture()
+settle_poll = 0.1 #seconds between gain polls
+settle_tolerance = 0.02 #relative change still counted as settled
+settle_stable_polls = 3 #polls in a row within tolerance
+settle_cap_max = 3.0 #never wait longer than the old fixed sleep
+settle_cap_min = 0.5
+settle_margin = 1.5 #cap is this times the slowest recent warm-up
+settle_history = 20 #warm-up times kept in settle_times_path
+settle_history_min = 5 #measurements needed before the cap tightens
+settle_times_path = '/home/pi/Desktop/mostrap1pics/.settletimes'
+memory_capture = True #capture into capture_buffer, upload from it, archive to disk in a thread
+capture_buffer_size = 8 * 1024 * 1024 #room for a full resolution jpeg
+capture_buffer = None #CaptureBuffer, made on the first capture of the wake and reused within it
+archive_threads = [] #threads writing captured frames to disk
+burst_frames = 0 #frames per wake through the video port, 0 or 1 for a single still
+burst_keep = 'sharpest' #'sharpest' archives the sharpest frame only, 'all' keeps every frame
+burst_buffers = [] #CaptureBuffers reused by capture_burst() within a wake
+burst_extras = [] #(frame number, path) of the other frames kept by the last burst
+luma_capture = False #also capture the luminance plane into luma for on device processing
+luma_jpeg = True #with luma_capture, also archive the yuv frame as a jpeg; False keeps the luminance only
+luma_jpeg_quality = 85 #quality of that jpeg, the one picamera uses for its own
+yuv_buffer = None #numpy array reused by capture_luma() within a wake
+luma = None #luminance plane of the last capture_luma()
+picture_archived = False #takepicture() saved a jpeg for this wake, name_of_picture is empty without one
+count_on_device = True #count the mosquitoes after the capture, see mosquitocount.py
+picture_count = -1 #mosquitoes in the last picture, -1 when not counted
+count_workers = 0 #processes counting tiles of the picture, 0 for one per core
+count_new_only = True #count only what changed since the last pictures, see count_new_arrivals()
+full_count_every = 24 #with count_new_only, every this many pictures the whole board is counted and the total reset, 0 never
+background_path = '/home/pi/Desktop/mostrap1pics/.background.npz' #small reference frames and total
+new_arrivals = -1 #mosquitoes new in the last picture, -1 when not counted
+track_mosquitoes = True #match the blobs with the ones of earlier pictures, see track_blobs()
+tracks_path = '/home/pi/Desktop/mostrap1pics/.tracks.npz' #one track per mosquito on the board
+classifier_path = '/home/pi/Desktop/mosquito_classifier.npz' #from train_classifier.py, blobs are not classified without it
+recapture_confidence = 0.5 #a frame counted with less confidence is taken again, see frame_confidence()
+recapture_max = 2 #frames taken again at most per wake
+recapture_exposure_step = 6 #exposure compensation change after a dark or bright frame, -25 to 25
+recapture_settle_extra = 1.0 #more settle seconds after a blurred or ambiguous frame
+recapture_stats_path = '/home/pi/Desktop/mostrap1pics/.recapturestats' #frames, rejections and sharpness per wake
+recapture_history = 20 #wakes kept in recapture_stats_path for the rejection rate and reference sharpness
+extra_settle = 0 #seconds added to the settle in takepicture(), raised by adjust_capture()
+picture_confidence = -1 #confidence of the last counted frame, -1 when not counted
+picture_sharpness = None #mosquitocount.sharpness() of the last counted frame
+frame_reason = None #why the last frame was not trusted, see frame_confidence()
+frames_taken = 0 #frames taken and rejected this wake, see capture_until_confident()
+frames_rejected = 0
+burst_stats_path = '/home/pi/Desktop/mostrap1pics/.burststats' #fps and sharpness per burst
+burst_history = 20 #bursts kept in burst_stats_path
 operationmode=False #mode variables
 hasWifi=False #wifi variables
-datafile_path = '/home/pi/Desktop/mostrap1pics/datafile'
-texts_from_file=[]
+probe_latency=None #seconds for a tcp connect to sync_host, set by checkwifi()
+wifi_interface = 'wlan0'
+sync_host = 'content.dropboxapi.com' #where the uploads go, probed by connectwifi()
+probe_timeout = 3
+wifi_backoff_first = 0.5 #seconds, doubling up to wifi_backoff_max with jitter
+wifi_backoff_max = 16
+wifi_wait_max = 130 #give up on the wifi after this many seconds
+fast_link_latency = 0.3 #a probe faster than this starts uploads with bigger chunks
+fast_link_chunk = 1024 * 1024
+marginal_link_latency = 1.0 #a probe slower than this uploads counts first, see count_first_tiers()
+count_first_time_budget = 60 #upload seconds on a marginal link when --time-budget is not given
+health_dir = '/home/pi/Desktop/mostrap1pics/health' #one record of a few hundred bytes per wake
+thumbnail_dir = '/home/pi/Desktop/mostrap1pics/thumbs' #1/8 scale pictures for marginal links
+thumbnail_quality = 70
+datafile_path = '/home/pi/Desktop/mostrap1pics/datafile' #old text ledger, read once into ledger_path
+ledger_path = '/home/pi/Desktop/mostrap1pics/ledger' #fixed width records, see ledger.py
+picture_ledger = None #ledger.Ledger, opened by open_ledger()
+listing_cache_path = '/home/pi/Desktop/mostrap1pics/.listingcache' #dot file, never uploaded
+upload_sessions_path = '/home/pi/Desktop/mostrap1pics/.uploadsessions' #in flight uploads
+upload_session_lifetime = 46 * 3600 #dropbox drops unfinished sessions after 48 hours
 newpicture = False
 name_of_picture=' '
+picture_path=None #where the last picture was saved
+picture_clock=None #monotonic() when the last picture was taken, see boot_pipeline()
 uploaded = False
 rebooting = True
 time_for_wake=120
+chunk_size_min = 256 * 1024 #upload session chunk limits, bytes
+chunk_size_max = 4 * 1024 * 1024
+chunk_size_step = 64 * 1024
+chunk_target_seconds = 2.0 #aim for chunks that take about this long to send
+chunk_size = chunk_size_min #grows or shrinks with the measured throughput
+finish_batch_max = 1000 #dropbox limit of entries per finish_batch call
+finish_batch_poll_min = 0.5 #seconds between finish_batch_check polls, doubling
+finish_batch_poll_max = 8
+finish_batch_polls = 20 #polls before a batch still in progress is left for the next wake
+content_hash_block = 4 * 1024 * 1024 #block size of the dropbox content_hash
+upload_deadline = None #time.time() after which chunked uploads stop, set by upload_pool()
+upload_sessions_lock = threading.Lock() #workers share the .uploadsessions file
+hash_cache_path = '/home/pi/Desktop/mostrap1pics/.hashcache' #content hashes by inode, size, mtime
+journal_path = '/home/pi/Desktop/mostrap1pics/.pendinguploads' #captures not uploaded yet
+reconcile_marker_path = '/home/pi/Desktop/mostrap1pics/.lastreconcile' #touched after a full walk
+reconcile_interval = 7 * 24 * 3600 #seconds between full walks of rootdir
 # OAuth2 access token.  TODO: login etc.
 TOKEN = 'SDyNJ4RmLfUAAAAAAAByX0pAIy__azpL2s0Zl7VjYlbcEeBxX0OnlfhOcM5W6V2k'
 parser = argparse.ArgumentParser(description='Sync /home/pi/Desktop/mostrap1pics to Dropbox')
@@ -79,42 +176,743 @@ parser.add_argument('--no', '-n', action='store_true',
                     help='Answer no to all questions')
 parser.add_argument('--default', '-d', action='store_true',
                     help='Take default answer on all questions')
+parser.add_argument('--batch', type=int, default=3, metavar='N',
+                    help='Commit new files in one batch when at least N are pending (0 disables)')
+parser.add_argument('--workers', type=int, default=2,
+                    help='Number of files uploaded at the same time')
+parser.add_argument('--byte-budget', type=float, default=0, metavar='MB',
+                    help='Stop uploading after this many megabytes this wake (0 for no limit)')
+parser.add_argument('--time-budget', type=float, default=0, metavar='SECONDS',
+                    help='Stop uploading after this many seconds this wake (0 for no limit)')
+parser.add_argument('--hash-processes', type=int, default=1,
+                    help='Number of processes hashing files that are not in the hash cache')
+parser.add_argument('--reconcile', action='store_true',
+                    help='Walk the whole local directory instead of reading the capture journal')
+parser.add_argument('--relist', action='store_true',
+                    help='Drop the saved listing cursor and list Dropbox from scratch')
+parser.add_argument('--count-first', action='store_true',
+                    help='Upload health records, then thumbnails, then full pictures, as on a marginal link')
+parser.add_argument('--calibrate-roi', action='store_true',
+                    help='Find the sticky board in a reference frame, save it as the capture region and exit')
+# one entry of the remote listing cache, client_modified is kept as a string
+RemoteEntry = namedtuple('RemoteEntry', 'name is_file size client_modified content_hash')
 # **************************************************************************************
 #DEF FUNCITONS *************************************************************************
 # **************************************************************************************
-def takepicture(value):
+def takepicture(value, named_by_time=None, journal=True):
     """
     if have wifi,take picture name it with the date and time
     else name it the number.
 
     and finally store it into the local file
+    named_by_time overrides the hasWifi check, journal=False leaves
+    the journal entry to the caller (see boot_pipeline()).
     """
     global camera
     global hasWifi
     global name_of_picture
-    fmt = '%m-%d-%H-%M-%S'
+    global picture_path
+    global picture_clock
+    global capture_buffer
+    global picture_archived
+    get_camera()
     print('obtaining time')
     j=str(value)
-    i = datetime.datetime.now(pytz.timezone('Asia/Singapore')).strftime(fmt)
+    i = picture_time_string(time.time())
     print(i)
+    if named_by_time is None:
+        named_by_time = hasWifi
     GPIO.output(20,GPIO.HIGH) #lightbulb
-    sleep(0.5)
+    if not adaptive_settle:
+        sleep(0.5)
     print('starting camera')
     camera.start_preview()
-    sleep(3) ##pauses for 3 seconds for camera to stablise
-    if hasWifi:
-        camera.capture('/home/pi/Desktop/mostrap1pics/mos%s.jpg' % i)
-        name_of_picture="mos"+str(j)+"mos"+str(i)+".jpg"
+    if adaptive_settle:
+        settle_camera() #lamp and gains settle together
     else:
-        camera.capture('/home/pi/Desktop/mostrap1pics/mos%s.jpg' % j)
-        name_of_picture="mos"+str(j)+".jpg"
-    sleep(1)
+        sleep(3) ##pauses for 3 seconds for camera to stablise
+    if extra_settle:
+        sleep(extra_settle) #taken again after a blurred frame
+    picture_path, name_of_picture = picture_names(j, i, named_by_time)
+    picture_clock = monotonic()
+    del burst_extras[:]
+    picture_archived = True
+    if luma_capture:
+        capture_luma()
+        picture_archived = luma_jpeg
+    if not picture_archived:
+        print('luminance only, no jpeg archived')
+        name_of_picture = '' #no file for the ledger to name
+    elif luma_capture:
+        #the archived frame is the counted frame, not a second exposure
+        if capture_buffer is None:
+            capture_buffer = CaptureBuffer(capture_buffer_size)
+        capture_buffer.reset()
+        encode_luma_jpeg(capture_buffer)
+        archive_capture(picture_path)
+    elif burst_frames > 1:
+        capture_burst(picture_path)
+    elif memory_capture:
+        if capture_buffer is None:
+            capture_buffer = CaptureBuffer(capture_buffer_size)
+        capture_buffer.reset()
+        camera.capture(capture_buffer, format='jpeg')
+        archive_capture(picture_path)
+    else:
+        camera.capture(picture_path)
+    if not adaptive_settle:
+        sleep(1)
     camera.stop_preview()
-    sleep(0.5)
+    if not adaptive_settle:
+        sleep(0.5)
     GPIO.output(20,GPIO.LOW) #lightbulb
+    if journal and picture_archived:
+        journal_capture(picture_path)
+        for k, extra in burst_extras:
+            journal_capture(extra)
     print('a picture was taken')
     return True
 
+class CaptureBuffer(object):
+    """Output for camera.capture() backed by one preallocated bytearray.
+
+    The same buffer is reused for every frame, and it reads back like a
+    file so the uploader can send the frame straight from memory.
+    """
+
+    def __init__(self, capacity):
+        self.data = bytearray(capacity)
+        self.size = 0
+        self.pos = 0
+        self.fullname = None #file the frame is archived to
+        self.mtime = None
+
+    def reset(self):
+        self.size = 0
+        self.pos = 0
+        self.fullname = None
+
+    def write(self, chunk):
+        end = self.size + len(chunk)
+        if end > len(self.data):
+            #grows once and stays that big for the next frames
+            self.data.extend(bytearray(end - len(self.data)))
+        self.data[self.size:end] = chunk
+        self.size = end
+        return len(chunk)
+
+    def flush(self):
+        pass
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        elif whence == 2:
+            pos += self.size
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, n=-1):
+        end = self.size if n < 0 else min(self.size, self.pos + n)
+        chunk = bytes(self.data[self.pos:end])
+        self.pos = end
+        return chunk
+
+def archive_capture(fullname, buf=None):
+    """Write the frame in buf (capture_buffer by default) to fullname
+    in a thread. The file gets the capture time as mtime, the one the
+    upload sends.
+    """
+    if buf is None:
+        buf = capture_buffer
+    buf.fullname = fullname
+    buf.mtime = time.time()
+    def write():
+        with open(fullname, 'wb') as f:
+            f.write(memoryview(buf.data)[:buf.size])
+            f.flush()
+            os.fsync(f.fileno())
+        os.utime(fullname, (buf.mtime, buf.mtime))
+    thread = threading.Thread(target=write)
+    thread.start()
+    archive_threads.append(thread)
+
+def wait_for_archive():
+    if archive_threads:
+        with stopwatch('waiting for the archive write'):
+            while archive_threads:
+                archive_threads.pop().join()
+
+def buffered(fullname):
+    """The CaptureBuffer holding the frame saved as fullname, or None."""
+    for buf in [capture_buffer] + burst_buffers:
+        if buf is not None and buf.fullname == fullname:
+            return buf
+    return None
+
+def capture_burst(fullname):
+    """Take burst_frames frames through the video port.
+
+    The frames go into burst_buffers, CaptureBuffers allocated on the
+    first burst of the wake and reused by the frames taken again after
+    it (the process exits at the end of a wake). Each frame is scored
+    with frame_sharpness(). The sharpest one becomes capture_buffer and
+    is archived as fullname. With burst_keep 'all' the other frames are
+    archived too, as burst_extra_path() names listed in burst_extras.
+    Return the frames per second the burst achieved.
+    """
+    global capture_buffer
+    while len(burst_buffers) < burst_frames:
+        burst_buffers.append(CaptureBuffer(capture_buffer_size))
+    frames = burst_buffers[:burst_frames]
+    for buf in frames:
+        buf.reset()
+    t0 = time.time()
+    camera.capture_sequence(frames, format='jpeg', use_video_port=True)
+    fps = len(frames) / max(time.time() - t0, 0.001)
+    with stopwatch('scoring %d frames' % len(frames)):
+        scores = [frame_sharpness(buf) for buf in frames]
+    best = scores.index(max(scores))
+    print('burst of %d frames at %.1f fps, sharpest is frame %d (%s)'
+          % (len(frames), fps, best, ', '.join('%.0f' % score for score in scores)))
+    record_history(burst_stats_path, [round(fps, 2)] + [round(score, 1) for score in scores],
+                   burst_history)
+    capture_buffer = frames[best]
+    archive_capture(fullname, capture_buffer)
+    if burst_keep == 'all':
+        for k, buf in enumerate(frames):
+            if k != best:
+                extra = burst_extra_path(fullname, k)
+                archive_capture(extra, buf)
+                burst_extras.append((k, extra))
+    return fps
+
+def burst_extra_path(fullname, k):
+    """Name of frame k of a burst kept next to the sharpest frame fullname."""
+    root, ext = os.path.splitext(fullname)
+    return '%s-%d%s' % (root, k, ext)
+
+def frame_sharpness(buf):
+    """Variance of the laplacian of a jpeg frame, higher is sharper.
+    The jpeg is decoded at 1/8 scale in grayscale, which only touches
+    the DC coefficients and costs a few milliseconds.
+    """
+    import numpy
+    from PIL import Image
+    buf.seek(0)
+    image = Image.open(buf)
+    image.draft('L', (image.size[0] // 8, image.size[1] // 8))
+    y = numpy.asarray(image.convert('L'), dtype=numpy.float32)
+    laplacian = (y[:-2, 1:-1] + y[2:, 1:-1] + y[1:-1, :-2] + y[1:-1, 2:]
+                 - 4 * y[1:-1, 1:-1])
+    return float(laplacian.var())
+
+def capture_luma():
+    """Capture one unencoded yuv frame and return its luminance plane.
+
+    The frame goes straight into yuv_buffer, a numpy array allocated on
+    the first capture of the wake and reused by the frames taken again
+    after it, so nothing is encoded or decoded. The returned array
+    is a (height, width) view of the Y plane without the padding the
+    camera adds to 32x16, and is also kept in luma.
+    """
+    global yuv_buffer
+    global luma
+    import numpy
+    width, height = camera.resolution
+    padded_width = (width + 31) // 32 * 32
+    padded_height = (height + 15) // 16 * 16
+    size = padded_width * padded_height * 3 // 2 #y plane then quarter size u and v
+    if yuv_buffer is None or yuv_buffer.size != size:
+        yuv_buffer = numpy.empty(size, dtype=numpy.uint8)
+    with stopwatch('yuv capture'):
+        camera.capture(yuv_buffer, format='yuv')
+    luma = yuv_buffer[:padded_width * padded_height].reshape(
+        padded_height, padded_width)[:height, :width]
+    return luma
+
+def encode_luma_jpeg(buf):
+    """Encode the yuv frame of the last capture_luma() as a jpeg into
+    buf, so the archived picture is the frame that was counted. The
+    quarter size u and v planes are scaled up to the y plane. The
+    encode runs on the cpu, a second exposure through the camera's
+    encoder would be quicker but is not the frame that was counted.
+    """
+    from PIL import Image
+    width, height = camera.resolution
+    padded_width = (width + 31) // 32 * 32
+    padded_height = (height + 15) // 16 * 16
+    plane = padded_width * padded_height
+    chroma = []
+    for start in (plane, plane + plane // 4):
+        c = yuv_buffer[start:start + plane // 4].reshape(
+            padded_height // 2, padded_width // 2)[:(height + 1) // 2, :(width + 1) // 2]
+        chroma.append(Image.fromarray(c.copy()).resize((width, height), Image.BILINEAR))
+    image = Image.merge('YCbCr', [Image.fromarray(luma.copy())] + chroma)
+    with stopwatch('jpeg from the yuv frame'):
+        image.save(buf, 'JPEG', quality=luma_jpeg_quality)
+
+def camera_gains():
+    """analog gain, digital gain and the two awb gains as floats."""
+    red, blue = camera.awb_gains
+    return (float(camera.analog_gain), float(camera.digital_gain),
+            float(red), float(blue))
+
+def settle_camera():
+    """Wait for the camera to settle after start_preview().
+
+    Polls the gains every settle_poll seconds until they stay within
+    settle_tolerance for settle_stable_polls polls in a row, or until
+    settle_cap() seconds have passed. Return the seconds waited.
+    A settle that hits the cap is recorded too, at the cap, so the next
+    cap is settle_margin times bigger and a slower (cold, dim) scene
+    gets the cap back up to what it needs.
+    """
+    cap = settle_cap()
+    t0 = time.time()
+    last = None
+    stable = 0
+    converged = False
+    while time.time() - t0 < cap:
+        sleep(settle_poll)
+        gains = camera_gains()
+        if (last is not None and gains[0] > 0 and
+            all(abs(a - b) <= settle_tolerance * max(abs(b), 0.01)
+                for a, b in zip(gains, last))):
+            stable += 1
+            if stable >= settle_stable_polls:
+                converged = True
+                break
+        else:
+            stable = 0
+        last = gains
+    waited = time.time() - t0
+    print('camera settled in %.2f s (cap %.2f s)%s'
+          % (waited, cap, '' if converged else ', gains still moving'))
+    record_settle_time(waited)
+    return waited
+
+def load_settle_times():
+    try:
+        with open(settle_times_path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return []
+
+def record_settle_time(seconds):
+    """Keep the last settle_history measured warm-up times."""
+    record_history(settle_times_path, seconds, settle_history)
+
+def record_history(path, value, length):
+    """Append value to the json list in path, keeping the last length values."""
+    try:
+        with open(path, 'r') as f:
+            values = json.load(f)
+    except (IOError, ValueError):
+        values = []
+    save_json(path, (values + [value])[-length:])
+
+def settle_cap():
+    """Hard cap for settle_camera(), settle_margin times the slowest
+    recent warm-up, so the cap tightens as measurements come in and
+    grows again after warm-ups that hit it.
+    """
+    times = load_settle_times()
+    if len(times) < settle_history_min:
+        return settle_cap_max
+    return max(settle_cap_min, min(settle_cap_max, max(times) * settle_margin))
+
+def get_camera():
+    """Make the PiCamera the first time it is needed."""
+    global camera
+    if camera is None:
+        from picamera import PiCamera
+        with stopwatch('starting PiCamera'):
+            camera = PiCamera()
+            roi = load_roi()
+            camera.resolution = roi_resolution(roi)
+            camera.zoom = roi
+            camera.framerate = camera_framerate
+    return camera
+
+def load_roi():
+    """The board region (x, y, w, h) as fractions of the sensor, saved
+    by calibrate_roi(). The whole sensor when there is none.
+    """
+    try:
+        with open(roi_path, 'r') as f:
+            return tuple(json.load(f))
+    except (IOError, ValueError):
+        return (0.0, 0.0, 1.0, 1.0)
+
+def roi_resolution(roi):
+    """Output resolution for a zoomed region at the full sensor pixel
+    density, rounded to what the camera encodes (multiples of 32x16).
+    """
+    width = max(32, int(round(camera_resolution[0] * roi[2] / 32.0)) * 32)
+    height = max(16, int(round(camera_resolution[1] * roi[3] / 16.0)) * 16)
+    return (width, height)
+
+def board_bbox(y):
+    """Bounding box (x, y, w, h), as fractions, of the sticky board in
+    a luminance image. The board is the bright part of the frame: the
+    rows and columns where more than half the pixels are above a
+    threshold halfway between the dark and bright percentiles.
+    """
+    import numpy
+    dark, bright = numpy.percentile(y, [5, 95])
+    mask = y > (dark + bright) / 2.0
+    rows = numpy.nonzero(mask.mean(axis=1) > 0.5)[0]
+    cols = numpy.nonzero(mask.mean(axis=0) > 0.5)[0]
+    if len(rows) == 0 or len(cols) == 0:
+        return (0.0, 0.0, 1.0, 1.0)
+    height, width = y.shape
+    return (float(cols[0]) / width, float(rows[0]) / height,
+            float(cols[-1] + 1 - cols[0]) / width,
+            float(rows[-1] + 1 - rows[0]) / height)
+
+def calibrate_roi():
+    """Find the board in a full sensor reference frame and save it as the ROI.
+    The box gets roi_margin on every side and is clipped to the sensor.
+    """
+    import picamera.array
+    get_camera()
+    camera.zoom = (0.0, 0.0, 1.0, 1.0)
+    camera.resolution = camera_resolution
+    GPIO.output(20,GPIO.HIGH) #lightbulb
+    camera.start_preview()
+    settle_camera()
+    with picamera.array.PiYUVArray(camera, size=roi_reference_size) as frame:
+        camera.capture(frame, 'yuv', resize=roi_reference_size)
+        y = frame.array[:, :, 0]
+    camera.stop_preview()
+    GPIO.output(20,GPIO.LOW) #lightbulb
+    x0, y0, w, h = board_bbox(y)
+    x1 = min(1.0, x0 + w + roi_margin)
+    y1 = min(1.0, y0 + h + roi_margin)
+    x0 = max(0.0, x0 - roi_margin)
+    y0 = max(0.0, y0 - roi_margin)
+    roi = (x0, y0, x1 - x0, y1 - y0)
+    save_json(roi_path, roi)
+    print('board found at x %.3f y %.3f w %.3f h %.3f, capturing %dx%d, %.0f%% of the frame'
+          % (roi + roi_resolution(roi) + (100 * roi[2] * roi[3],)))
+    return roi
+
+def close_camera():
+    global camera
+    if camera is not None:
+        camera.close()
+        camera = None
+
+def load_dropbox():
+    """Import the dropbox sdk the first time it is needed."""
+    global dropbox
+    global FileMetadata
+    global FolderMetadata
+    if dropbox is None:
+        with stopwatch('importing dropbox'):
+            import dropbox as sdk
+            from dropbox.files import FileMetadata, FolderMetadata
+        dropbox = sdk
+    return dropbox
+
+def picture_time_string(t):
+    """Time string of unix time t for the picture names."""
+    import pytz
+    return datetime.datetime.fromtimestamp(t, pytz.timezone('Asia/Singapore')).strftime('%m-%d-%H-%M-%S')
+
+def monotonic():
+    """Seconds on a clock the ntp sync does not step, to time the
+    capture across the wifi coming up.
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic()
+    return os.times()[4] #linux: real time elapsed since boot
+
+def picture_names(j, i, named_by_time):
+    """Return (path on disk, name for the ledger) of picture number j taken at time i."""
+    if named_by_time:
+        return ('/home/pi/Desktop/mostrap1pics/mos%s.jpg' % i,
+                "mos"+str(j)+"mos"+str(i)+".jpg")
+    return ('/home/pi/Desktop/mostrap1pics/mos%s.jpg' % j,
+            "mos"+str(j)+".jpg")
+
+def boot_pipeline(value, capture):
+    """Probe the wifi and take picture number value at the same time.
+
+    checkwifi() runs in a thread while the lamp and camera do their
+    work here. The picture is named by number first. Once the wifi
+    (and so the clock) turns out to be good, the capture time is worked
+    out again as now minus the monotonic() time since the capture, and
+    the picture is renamed to it and given it as mtime, the same names
+    takepicture() gives when run after checkwifi().
+    Prints and returns the time spent in each phase.
+    """
+    global picture_path
+    global name_of_picture
+    timings = {}
+    def timed(phase, func, *args, **kwargs):
+        t0 = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timings[phase] = timings.get(phase, 0) + time.time() - t0
+    t0 = time.time()
+    wifi = threading.Thread(target=timed, args=('wifi', checkwifi))
+    wifi.daemon = True
+    wifi.start()
+    try:
+        if capture:
+            capture_until_confident(value, timed)
+    finally:
+        wifi.join()
+    if capture and picture_archived:
+        if hasWifi:
+            #the clock read at capture time was not trusted yet
+            taken = time.time() - (monotonic() - picture_clock)
+            path, name_of_picture = picture_names(str(value), picture_time_string(taken), True)
+            wait_for_archive()
+            for fullname in [picture_path] + [extra for k, extra in burst_extras]:
+                os.utime(fullname, (taken, taken))
+                if buffered(fullname) is not None:
+                    buffered(fullname).mtime = taken
+            renamed = []
+            for k, extra in burst_extras:
+                os.rename(extra, burst_extra_path(path, k))
+                buffered(extra).fullname = burst_extra_path(path, k)
+                renamed.append((k, burst_extra_path(path, k)))
+            burst_extras[:] = renamed
+            os.rename(picture_path, path)
+            if buffered(picture_path) is not None:
+                buffered(picture_path).fullname = path
+            picture_path = path
+        journal_capture(picture_path)
+        for k, extra in burst_extras:
+            journal_capture(extra)
+    timings['total'] = time.time() - t0
+    print('boot pipeline: wifi %.1f s, capture %.1f s, count %.1f s, awake %.1f s instead of %.1f s'
+          % (timings['wifi'], timings.get('capture', 0), timings.get('count', 0),
+             timings['total'],
+             timings['wifi'] + timings.get('capture', 0) + timings.get('count', 0)))
+    return timings
+
+def capture_until_confident(value, timed):
+    """Take picture number value and count it, taking it again with
+    adjust_capture() while count_picture() rejects the frame, at most
+    recapture_max times; the last frame is always kept. timed(phase,
+    func, ...) runs and times each step for boot_pipeline().
+    The frames and rejections go into recapture_stats_path, and the
+    rejection rate over the recent wakes is printed.
+    """
+    global frames_taken
+    global frames_rejected
+    global extra_settle
+    frames_taken = 0
+    frames_rejected = 0
+    attempts = recapture_max + 1 if count_on_device else 1
+    for attempt in range(attempts):
+        if attempt:
+            wait_for_archive() #the next frame reuses the capture buffer and the file name
+            adjust_capture(frame_reason)
+        timed('capture', takepicture, value, named_by_time=False, journal=False)
+        frames_taken += 1
+        if not count_on_device:
+            return
+        if timed('count', count_picture, value, attempt == attempts - 1) is not None:
+            break
+        frames_rejected += 1
+    if frames_rejected:
+        camera.exposure_compensation = 0
+        extra_settle = 0
+    trusted = picture_confidence >= recapture_confidence
+    record_history(recapture_stats_path, {'frames': frames_taken, 'rejected': frames_rejected,
+                                          'sharpness': picture_sharpness if trusted else None},
+                   recapture_history)
+    print('%d frame(s) taken, %d rejected, %.0f%% of frames rejected over the last wakes'
+          % (frames_taken, frames_rejected, 100 * rejection_rate()))
+
+def adjust_capture(reason):
+    """Change the capture for a frame rejected for reason: exposure
+    compensation for a dark or bright frame, a longer settle for the
+    lamp and camera after a blurred or ambiguous one.
+    """
+    global extra_settle
+    print('frame rejected (%s), taking it again' % reason)
+    if reason in ('dark', 'bright'):
+        step = recapture_exposure_step if reason == 'dark' else -recapture_exposure_step
+        camera.exposure_compensation = max(-25, min(25, camera.exposure_compensation + step))
+    else:
+        extra_settle += recapture_settle_extra
+
+def load_recapture_stats():
+    try:
+        with open(recapture_stats_path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return []
+
+def rejection_rate():
+    """Share of the frames of the recent wakes that were taken again."""
+    stats = load_recapture_stats()
+    frames = sum(wake['frames'] for wake in stats)
+    return sum(wake['rejected'] for wake in stats) / float(frames) if frames else 0.0
+
+def reference_sharpness():
+    """Median sharpness of the recent trusted frames, None without any."""
+    values = sorted(wake['sharpness'] for wake in load_recapture_stats()
+                    if wake.get('sharpness') is not None)
+    return values[len(values) // 2] if values else None
+
+def accept_frame(y, blobs, final):
+    """Rate the frame with frame_confidence() and say whether its count
+    can be kept. Only frames before the final one are ever rejected.
+    """
+    global picture_confidence
+    global picture_sharpness
+    global frame_reason
+    import mosquitocount
+    picture_confidence, frame_reason, picture_sharpness = mosquitocount.frame_confidence(
+        y, blobs, reference=reference_sharpness())
+    print('frame confidence %.2f%s' % (picture_confidence,
+                                       ' (%s)' % frame_reason if frame_reason else ''))
+    return final or picture_confidence >= recapture_confidence
+
+def count_picture(index=-1, final=True):
+    """Count the mosquitoes in picture number index with mosquitocount.
+
+    Uses the luminance plane from capture_luma() when there is one,
+    otherwise decodes the jpeg, from memory when it is still there.
+    With count_new_only only the regions that changed against the
+    background in background_path are counted, giving new_arrivals,
+    and picture_count is the running total. Every full_count_every
+    pictures the whole board is counted instead and the total starts
+    again from it, so a false arrival does not stay in it for good
+    and the count compares with recount_archive.py.
+    With a model at classifier_path, blobs it takes for debris, flies
+    or glare are dropped before anything else.
+    With track_mosquitoes the blobs are matched with the tracks in
+    tracks_path and only the ones never seen before are new_arrivals.
+    Unless final, a frame accept_frame() does not trust returns None
+    before anything is saved, to be taken again.
+    Sets and returns picture_count, -1 when it could not be counted;
+    counting never stops the capture and upload cycle.
+    """
+    global picture_count
+    global new_arrivals
+    picture_count = -1
+    new_arrivals = -1
+    try:
+        import mosquitocount
+        if luma is not None:
+            y = luma
+        else:
+            y = mosquitocount.read_luma(buffered(picture_path) or picture_path)
+        if count_new_only:
+            saved = mosquitocount.load_background(background_path)
+            frames, total = saved if saved is not None else (None, 0)
+            if full_count_every and index > 0 and index % full_count_every == 0:
+                frames = None #count the whole board, the stack starts again
+            with stopwatch('counting new arrivals'):
+                new_arrivals, blobs, frames = mosquitocount.count_new_arrivals(y, frames)
+            blobs = classify_picture(y, blobs)
+            if not accept_frame(y, blobs, final):
+                new_arrivals = -1
+                return None
+            new_arrivals = len(blobs['area'])
+            whole_board = len(frames) == 1 #first picture or a new board, everything was counted
+            counted = new_arrivals
+            if track_mosquitoes:
+                new_arrivals = track_picture(blobs, index, whole_board)
+            picture_count = counted if whole_board else total + new_arrivals
+            mosquitocount.save_background(background_path, frames, picture_count)
+            print('%d new mosquitoes, %d on the board' % (new_arrivals, picture_count))
+            return picture_count
+        workers = count_workers
+        if not workers:
+            import multiprocessing
+            workers = multiprocessing.cpu_count()
+        with stopwatch('counting on %d cores' % workers):
+            if workers > 1:
+                picture_count, blobs = mosquitocount.count_mosquitoes_tiled(y, workers=workers)
+            else:
+                picture_count, blobs = mosquitocount.count_mosquitoes(y)
+        blobs = classify_picture(y, blobs)
+        if not accept_frame(y, blobs, final):
+            picture_count = -1
+            return None
+        picture_count = len(blobs['area'])
+        if track_mosquitoes:
+            new_arrivals = track_picture(blobs, index, True)
+        print('%d mosquitoes counted' % picture_count)
+    except Exception:
+        print('counting failed')
+        print(sys.exc_info()[0])
+    return picture_count
+
+def classify_picture(y, blobs):
+    """The blobs the model at classifier_path takes for mosquitoes,
+    all of them when there is no model.
+    """
+    import mosquitocount
+    model = mosquitocount.load_classifier(classifier_path)
+    if model is None:
+        return blobs
+    with stopwatch('classifying %d blobs' % len(blobs['area'])):
+        return mosquitocount.filter_blobs(y, blobs, model)
+
+def track_picture(blobs, index, whole_board):
+    """Match the blobs of picture index with the tracks in tracks_path
+    and return how many were never seen before. When the blobs are the
+    whole board, tracks not seen in it are gone and dropped.
+    """
+    import mosquitocount
+    tracks = mosquitocount.load_tracks(tracks_path)
+    with stopwatch('tracking %d blobs' % len(blobs['area'])):
+        first, tracks = mosquitocount.track_blobs(blobs, index, tracks)
+    if whole_board:
+        tracks = mosquitocount.select_blobs(tracks, tracks['last'] == index)
+    mosquitocount.save_tracks(tracks_path, tracks)
+    return int((first == index).sum())
+
+def journal_capture(fullname):
+    """Append a new picture to the pending upload journal, read by mainsyncprogram()."""
+    with open(journal_path, 'a') as f:
+        f.write(fullname + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def read_journal():
+    """Return the journalled file names, oldest first, without repeats.
+    None when there is no journal yet.
+    """
+    try:
+        with open(journal_path, 'r') as f:
+            lines = f.read().splitlines()
+    except IOError:
+        return None
+    names = []
+    for line in lines:
+        if line and line not in names:
+            names.append(line)
+    return names
+
+def rewrite_journal(names):
+    tmp = journal_path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.writelines(name + '\n' for name in names)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, journal_path)
+
+def reconcile_due():
+    """A full walk is due when it never ran or ran more than reconcile_interval ago."""
+    try:
+        return time.time() - os.path.getmtime(reconcile_marker_path) > reconcile_interval
+    except OSError:
+        return True
+
 def setupgpio():
     GPIO.setmode(GPIO.BCM)
     GPIO.setwarnings(False)
@@ -135,11 +933,16 @@ def mainsyncprogram():
     """Main program.
     This handles the uploading part, makes use of "upload()" function.
 
-    Parse command line, then iterate over files and directories under
-    rootdir and upload all files.  Skips some temporary files and
+    Parse command line, then iterate over the captures journalled by
+    takepicture() (or, when reconciling, over all files and directories
+    under rootdir) and upload them.  Skips some temporary files and
     directories, and avoids duplicate uploads by comparing size and
-    mtime with the server.
+    mtime with the server, then the content hash when those differ.
+    On a marginal link (or with --count-first) the health records go
+    first, then thumbnails, then full pictures while budget remains.
     """
+    global chunk_size
+    import six
 
     args = parser.parse_args()
     if sum([bool(b) for b in (args.yes, args.no, args.default)]) > 1:
@@ -160,48 +963,212 @@ def mainsyncprogram():
         print(rootdir, 'is not a foldder on your filesystem')
         sys.exit(1)
 
+    if probe_latency is not None and probe_latency < fast_link_latency:
+        chunk_size = max(chunk_size, fast_link_chunk)
+    count_first = args.count_first or (probe_latency is not None and
+                                       probe_latency >= marginal_link_latency)
+    load_dropbox()
     dbx = dropbox.Dropbox(args.token)
+    remote = list_remote_tree(dbx, folder, relist=args.relist)
+    pending = [] #new files, uploaded after the walk
+    changed = [] #files whose stats differ from dropbox, hashed after the walk
+    hash_cache = load_hash_cache()
+    seen = set()
 
-    for dn, dirs, files in os.walk(rootdir):
+    reconcile = args.reconcile or reconcile_due() or read_journal() is None
+    if reconcile:
+        print('reconciling, walking all of', rootdir)
+        candidates = walk_files(rootdir, args)
+    else:
+        #only the journalled captures and the ledger, however big the archive gets
+        candidates = [os.path.split(fullname)
+                      for fullname in read_journal() + [ledger_path]
+                      if os.path.exists(fullname)]
+
+    for dn, name in candidates:
         subfolder = dn[len(rootdir):].strip(os.path.sep)
-        listing = list_folder(dbx, folder, subfolder)
-        print('Descending into', subfolder, '...')
+        fullname = os.path.join(dn, name)
+        if not isinstance(name, six.text_type):
+            name = name.decode('utf-8')
+            print(name)
+        nname = unicodedata.normalize('NFC', name)
+        if name.startswith('.'):
+            print('Skipping dot file:', name)
+        elif name.startswith('@') or name.endswith('~'):
+            print('Skipping temporary file:', name)
+        elif name.endswith('.pyc') or name.endswith('.pyo'):
+            print('Skipping generated file:', name)
+        elif remote_key(subfolder, nname) in remote:
+            seen.add(fullname)
+            md = remote[remote_key(subfolder, nname)]
+            mtime = os.path.getmtime(fullname)
+            mtime_dt = datetime.datetime(*time.gmtime(mtime)[:6])
+            size = os.path.getsize(fullname)
+            if (md.is_file and size == md.size and
+                mtime_dt.strftime(remote_time_fmt) == md.client_modified):
+                print(name, 'is already synced [stats match]')
+            else:
+                print(name, 'exists with different stats, hashing')
+                changed.append((fullname, subfolder, name, md))
+        elif yesno('Upload %s' % name, True, args):
+            pending.append((fullname, subfolder, name))
+
+    hashes = hash_files(hash_cache, [c[0] for c in changed], args.hash_processes)
+    for fullname, subfolder, name, md in changed:
+        if md.is_file and md.content_hash == hashes[fullname]:
+            print(name, 'is already synced [content match]')
+        else:
+            print(name, 'has changed since last sync')
+            if yesno('Refresh %s' % name, False, args):
+                upload(dbx, fullname, folder, subfolder, name, overwrite=True)
+    if reconcile:
+        evict_hash_cache(hash_cache, seen)
+    save_json(hash_cache_path, hash_cache)
+
+    wait_for_archive() #the new picture has to be on disk with its final mtime
+    pending.sort(key=lambda job: os.path.getmtime(job[0]), reverse=True) #newest pictures first
+    byte_budget = int(args.byte_budget * 1024 * 1024)
+    time_budget = args.time_budget
+    if count_first:
+        time_budget = time_budget or count_first_time_budget
+        tiers = count_first_tiers(rootdir, remote, pending)
+        print('marginal link, uploading %d health records, then %d thumbnails, then %d files'
+              % tuple(len(tier) for tier in tiers))
+        pending = [job for tier in tiers for job in tier]
+    else:
+        tiers = [pending]
+    uploaded_names = set()
+    started = time.time()
+    spent = 0
+    for tier in tiers:
+        if not tier:
+            continue #no pool for a tier with nothing to upload
+        time_left = time_budget - (time.time() - started) if time_budget else 0
+        bytes_left = byte_budget - spent if byte_budget else 0
+        if (time_budget and time_left <= 0) or (byte_budget and bytes_left <= 0):
+            print('budget spent, leaving the rest for the next wake')
+            break
+        uploaded = upload_jobs(dbx, args, folder, tier, bytes_left, time_left)
+        spent += sum(os.path.getsize(fullname) for fullname in uploaded)
+        uploaded_names |= uploaded
+    #whatever is still pending stays in the journal for the next wake
+    rewrite_journal([job[0] for job in reversed(pending) if job[0] not in uploaded_names])
+    if reconcile:
+        open(reconcile_marker_path, 'w').close()
+    print('upload fully finished and sucessful')
+    return True
+
+def upload_jobs(dbx, args, folder, jobs, byte_budget, time_budget):
+    """Upload (fullname, subfolder, name) jobs with upload_pool(),
+    committed as one batch when there are at least args.batch of them.
+    Return the set of local file names that made it to Dropbox.
+    """
+    batch = args.batch and len(jobs) >= args.batch
+    if batch:
+        print('%d new files, committing them as one batch' % len(jobs))
+        def work(dbx, job):
+            return stage_for_batch(dbx, job[0], remote_path(folder, job[1], job[2]),
+                                   dropbox.files.WriteMode.add, buffered(job[0]))
+    else:
+        def work(dbx, job):
+            return upload(dbx, job[0], folder, job[1], job[2], source=buffered(job[0]))
+    deadline = time.time() + time_budget if time_budget else None
+    done = upload_pool(args.token, jobs, work, args.workers, byte_budget, time_budget)
+    if batch:
+        committed = upload_batch(dbx, [(job[0], res) for job, res in done if res is not None],
+                                 deadline)
+        uploaded_paths = set(md.path_lower for md in committed)
+        return set(job[0] for job in jobs
+                   if remote_path(folder, job[1], job[2]).lower() in uploaded_paths)
+    return set(job[0] for job, res in done if res is not None)
+
+def count_first_tiers(rootdir, remote, pending):
+    """Split the pending uploads for a marginal link into health
+    records, thumbnails and everything else, in that order.
+    Pictures still pending get a thumbnail from make_thumbnail(),
+    unless dropbox already has one.
+    """
+    health, thumbs, rest = [], [], []
+    for job in pending:
+        dn = os.path.dirname(job[0])
+        if dn == health_dir:
+            health.append(job)
+        elif dn == thumbnail_dir:
+            if job not in thumbs:
+                thumbs.append(job)
+        else:
+            rest.append(job)
+            if not (job[2].startswith('mos') and job[2].endswith('.jpg')):
+                continue
+            subfolder = thumbnail_dir[len(rootdir):].strip(os.path.sep)
+            if remote_key(subfolder, job[2]) in remote:
+                continue
+            try:
+                thumb = (make_thumbnail(job[0]), subfolder, job[2])
+            except Exception:
+                print('no thumbnail for %s' % job[0])
+                print(sys.exc_info()[0])
+                continue
+            if thumb not in thumbs:
+                thumbs.append(thumb)
+    return [health, thumbs, rest]
 
-        # First do all the files.
+def make_thumbnail(fullname):
+    """Save a 1/8 scale copy of a picture in thumbnail_dir, under the
+    same name, and return its path. The jpeg is decoded in draft mode,
+    from memory when it is still there, which costs milliseconds.
+    """
+    from PIL import Image
+    thumb = os.path.join(thumbnail_dir, os.path.basename(fullname))
+    if os.path.exists(thumb):
+        return thumb
+    if not os.path.isdir(thumbnail_dir):
+        os.makedirs(thumbnail_dir)
+    source = buffered(fullname)
+    if source is not None:
+        source.seek(0)
+    image = Image.open(source or fullname)
+    image.draft('RGB', (image.size[0] // 8, image.size[1] // 8))
+    image.convert('RGB').save(thumb + '.tmp', 'JPEG', quality=thumbnail_quality)
+    os.rename(thumb + '.tmp', thumb)
+    return thumb
+
+def write_health(index, timings, reboots, picture=None):
+    """Write the health record of this wake to health_dir and journal it.
+    One line of json, a few hundred bytes: the picture index and name,
+    the counts, battery voltage, boot timings, wifi probe latency and
+    reboots, so a marginal link still gets the numbers through.
+    """
+    record = {'index': index, 'picture': picture, 'count': picture_count,
+              'new': new_arrivals, 'voltage': battery_voltage(), 'reboots': reboots,
+              'latency': probe_latency, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'confidence': round(picture_confidence, 2), 'frames': frames_taken,
+              'rejected': frames_rejected}
+    for phase, seconds in timings.items():
+        record[phase] = round(seconds, 2)
+    if not os.path.isdir(health_dir):
+        os.makedirs(health_dir)
+    fullname = os.path.join(health_dir, 'h%d-%d.json' % (index, reboots))
+    save_json(fullname, record)
+    journal_capture(fullname)
+    return fullname
+
+def battery_voltage():
+    """Battery voltage from the mopi in volts, None when it cannot be read."""
+    try:
+        import mopiapi
+        return mopiapi.mopiapi().getVoltage() / 1000.0
+    except Exception:
+        return None
+
+def walk_files(rootdir, args):
+    """Yield (directory, file name) for every file under rootdir,
+    skipping dot, temporary and generated directories.
+    """
+    for dn, dirs, files in os.walk(rootdir):
+        print('Descending into', dn[len(rootdir):].strip(os.path.sep), '...')
         for name in files:
-            fullname = os.path.join(dn, name)
-            if not isinstance(name, six.text_type):
-                name = name.decode('utf-8')
-                print(name)
-            nname = unicodedata.normalize('NFC', name)
-            if name.startswith('.'):
-                print('Skipping dot file:', name)
-            elif name.startswith('@') or name.endswith('~'):
-                print('Skipping temporary file:', name)
-            elif name.endswith('.pyc') or name.endswith('.pyo'):
-                print('Skipping generated file:', name)
-            elif nname in listing:
-                md = listing[nname]
-                mtime = os.path.getmtime(fullname)
-                mtime_dt = datetime.datetime(*time.gmtime(mtime)[:6])
-                size = os.path.getsize(fullname)
-                if (isinstance(md, dropbox.files.FileMetadata) and
-                    mtime_dt == md.client_modified and size == md.size):
-                    print(name, 'is already synced [stats match]')
-                else:
-                    print(name, 'exists with different stats, downloading')
-                    res = download(dbx, folder, subfolder, name)
-                    with open(fullname) as f:
-                        data = f.read()
-                    if res == data:
-                        print(name, 'is already synced [content match]')
-                    else:
-                        print(name, 'has changed since last sync')
-                        if yesno('Refresh %s' % name, False, args):
-                            upload(dbx, fullname, folder, subfolder, name,
-                                   overwrite=True)
-            elif yesno('Upload %s' % name, True, args):
-                upload(dbx, fullname, folder, subfolder, name)
+            yield dn, name
 
         # Then choose which subdirectories to traverse.
         keep = []
@@ -218,61 +1185,190 @@ def mainsyncprogram():
             else:
                 print('OK, skipping directory:', name)
         dirs[:] = keep
-    print('upload fully finished and sucessful')
-    return True
 
-def list_folder(dbx, folder, subfolder):
-    """List a folder.
+remote_time_fmt = '%Y-%m-%dT%H:%M:%S'
 
-    Return a dict mapping unicode filenames to
-    FileMetadata|FolderMetadata entries.
+def remote_key(subfolder, name):
+    """Key of a local file in the remote listing cache.
+    Dropbox paths are case insensitive so the key is lower cased
+    the same way as path_lower.
     """
-    path = '/%s/%s' % (folder, subfolder.replace(os.path.sep, '/'))
-    while '//' in path:
-        path = path.replace('//', '/')
-    path = path.rstrip('/')
+    key = '%s/%s' % (subfolder.replace(os.path.sep, '/'), name)
+    return key.strip('/').lower()
+
+def load_listing_cache(folder):
+    """Read the saved cursor and entries, empty cache if missing or for another folder."""
     try:
-        with stopwatch('list_folder'):
-            res = dbx.files_list_folder(path)
+        with open(listing_cache_path, 'r') as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return {'folder': folder, 'cursor': None, 'entries': {}}
+    if cache.get('folder') != folder:
+        print('listing cache is for another folder, starting over')
+        return {'folder': folder, 'cursor': None, 'entries': {}}
+    return cache
+
+def save_json(path, obj):
+    """Write obj to a temp file first so a power cut never leaves half a file."""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+def save_listing_cache(cache):
+    save_json(listing_cache_path, cache)
+
+def apply_listing_entries(cache, entries, root):
+    """Fold one page of list_folder results into the cache entries."""
+    table = cache['entries']
+    for entry in entries:
+        key = entry.path_lower[len(root):].strip('/')
+        if not key:
+            continue
+        if isinstance(entry, dropbox.files.DeletedMetadata):
+            table.pop(key, None)
+            for child in [k for k in table if k.startswith(key + '/')]:
+                del table[child]
+        elif isinstance(entry, FileMetadata):
+            table[key] = [entry.name, True, entry.size,
+                          entry.client_modified.strftime(remote_time_fmt),
+                          entry.content_hash]
+        elif isinstance(entry, FolderMetadata):
+            table[key] = [entry.name, False, 0, None, None]
+
+def list_remote_tree(dbx, folder, relist=False):
+    """List the whole Dropbox folder recursively, once per sync.
+
+    The cursor from the last sync is saved in listing_cache_path so
+    each boot only fetches what changed since then, following has_more
+    until the delta is exhausted. Return a dict mapping remote_key()
+    keys to RemoteEntry tuples.
+    """
+    root = ('/%s' % folder.strip('/')).lower()
+    cache = load_listing_cache(folder)
+    if relist:
+        cache = {'folder': folder, 'cursor': None, 'entries': {}}
+    try:
+        with stopwatch('list_remote_tree'):
+            res = None
+            if cache['cursor']:
+                try:
+                    res = dbx.files_list_folder_continue(cache['cursor'])
+                except dropbox.exceptions.ApiError as err:
+                    print('saved cursor rejected, listing from scratch:', err)
+                    cache['entries'] = {}
+            if res is None:
+                res = dbx.files_list_folder(root, recursive=True)
+            apply_listing_entries(cache, res.entries, root)
+            while res.has_more:
+                res = dbx.files_list_folder_continue(res.cursor)
+                apply_listing_entries(cache, res.entries, root)
+            cache['cursor'] = res.cursor
     except dropbox.exceptions.ApiError as err:
-        print('Folder listing failed for', path, '-- assumped empty:', err)
-        return {}
+        #folder not created yet or listing broke half way, keep the old cache
+        print('Folder listing failed for', root, '-- using cached listing:', err)
     else:
-        rv = {}
-        for entry in res.entries:
-            rv[entry.name] = entry
-        return rv
+        save_listing_cache(cache)
+    print('%d remote entries known' % len(cache['entries']))
+    return dict((key, RemoteEntry(*value))
+                for key, value in cache['entries'].items())
+
+def content_hash(fullname):
+    """Dropbox content_hash of a local file.
+
+    SHA-256 of each 4 MiB block, then SHA-256 of the concatenated block
+    digests, so it can be compared with FileMetadata.content_hash
+    without downloading the remote file.
+    """
+    overall = hashlib.sha256()
+    with open(fullname, 'rb') as f:
+        while True:
+            block = f.read(content_hash_block)
+            if not block:
+                break
+            overall.update(hashlib.sha256(block).digest())
+    return overall.hexdigest()
 
-def download(dbx, folder, subfolder, name):
-    """Download a file.
+def stat_key(st):
+    """(inode, size, mtime_ns) of an os.stat result, the hash cache key."""
+    return [st.st_ino, st.st_size, getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9))]
 
-    Return the bytes of the file, or None if it doesn't exist.
+def load_hash_cache():
+    """Read the hash cache, a dict mapping local file names to
+    [inode, size, mtime_ns, content_hash].
     """
+    try:
+        with open(hash_cache_path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def hash_files(cache, names, processes=1):
+    """Return a dict mapping each file name to its content_hash.
+
+    Only files whose (inode, size, mtime_ns) are not in the cache are
+    read and hashed, on a pool of processes when there are several of
+    them, and the cache is updated with the new hashes.
+    """
+    hashes = {}
+    misses = []
+    for fullname in names:
+        key = stat_key(os.stat(fullname))
+        entry = cache.get(fullname)
+        if entry is not None and entry[:3] == key:
+            hashes[fullname] = entry[3]
+        else:
+            misses.append((fullname, key))
+    if not misses:
+        return hashes
+    with stopwatch('hashing %d files' % len(misses)):
+        if processes > 1 and len(misses) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(min(processes, len(misses)))
+            try:
+                digests = pool.map(content_hash, [m[0] for m in misses])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            digests = [content_hash(m[0]) for m in misses]
+    for (fullname, key), digest in zip(misses, digests):
+        cache[fullname] = key + [digest]
+        hashes[fullname] = digest
+    return hashes
+
+def evict_hash_cache(cache, seen):
+    """Drop cache entries of files that were not seen in this walk."""
+    for fullname in [f for f in cache if f not in seen]:
+        del cache[fullname]
+
+def remote_path(folder, subfolder, name):
     path = '/%s/%s/%s' % (folder, subfolder.replace(os.path.sep, '/'), name)
     while '//' in path:
         path = path.replace('//', '/')
-    with stopwatch('download'):
-        try:
-            md, res = dbx.files_download(path)
-        except dropbox.exceptions.HttpError as err:
-            print('*** HTTP error', err)
-            return None
-    data = res.content
-    print(len(data), 'bytes; md:', md)
-    return data
+    return path
 
-def upload(dbx, fullname, folder, subfolder, name, overwrite=False):
+def upload(dbx, fullname, folder, subfolder, name, overwrite=False, source=None):
     """Upload a file.
+    source is a CaptureBuffer holding the same bytes as fullname, read
+    instead of the file when given.
     Return the request response, or None in case of error.
     """
-    path = '/%s/%s/%s' % (folder, subfolder.replace(os.path.sep, '/'), name)
-    while '//' in path:
-        path = path.replace('//', '/')
+    path = remote_path(folder, subfolder, name)
     mode = (dropbox.files.WriteMode.overwrite
             if overwrite
             else dropbox.files.WriteMode.add)
     mtime = os.path.getmtime(fullname)
-    with open(fullname, 'rb') as f:
+    size = os.path.getsize(fullname)
+    if size > chunk_size:
+        #files bigger than one chunk go through an upload session, chunk by chunk
+        res = upload_session(dbx, fullname, path, mode, mtime, size, source)
+        if res is not None:
+            print('uploaded as', res.name.encode('utf8'))
+        return res
+    with upload_source(fullname, source) as f:
         data = f.read()
     with stopwatch('upload %d bytes' % len(data)):
         print('starting upload')
@@ -287,48 +1383,401 @@ def upload(dbx, fullname, folder, subfolder, name, overwrite=False):
     print('uploaded as', res.name.encode('utf8'))
     return res
 
+def next_chunk_size(nbytes, seconds):
+    """Size the next chunk so it takes about chunk_target_seconds
+    at the throughput measured on the last one.
+    """
+    rate = nbytes / max(seconds, 0.001)
+    size = int(rate * chunk_target_seconds)
+    size -= size % chunk_size_step
+    return max(chunk_size_min, min(chunk_size_max, size))
+
+class BudgetSpent(Exception):
+    """Raised by stage_upload() when upload_deadline has passed, and by
+    finish_upload_batch() when the batch job outlasts its polls."""
+
+@contextlib.contextmanager
+def upload_source(fullname, source=None):
+    """Open fullname for reading, or rewind source when there is one."""
+    if source is not None:
+        source.seek(0)
+        yield source
+    else:
+        with open(fullname, 'rb') as f:
+            yield f
+
+def commit_info(path, mode, mtime):
+    return dropbox.files.CommitInfo(
+        path=path, mode=mode,
+        client_modified=datetime.datetime(*time.gmtime(mtime)[:6]),
+        mute=True)
+
+def upload_session(dbx, fullname, path, mode, mtime, size, source=None):
+    """Upload a file with files_upload_session_start/append_v2/finish.
+
+    Only one chunk is held in memory at a time (at most chunk_size_max
+    bytes) and a dropped connection only loses the chunk in flight.
+    The chunk size follows the measured throughput and is kept in
+    chunk_size for the next file.
+    Return the FileMetadata, or None in case of error.
+    """
+    with stopwatch('upload session %d bytes' % size):
+        try:
+            cursor, tail = stage_upload(dbx, fullname, size, mtime, source=source)
+            res = dbx.files_upload_session_finish(tail, cursor,
+                                                  commit_info(path, mode, mtime))
+        except dropbox.exceptions.ApiError as err:
+            print('*** API error', err)
+            return None
+    forget_upload_session(fullname)
+    return res
+
+def stage_upload(dbx, fullname, size, mtime, close=False, source=None):
+    """Send a file to an upload session without committing it.
+
+    With close=False the last chunk is not sent but returned, so the
+    caller can pass it to files_upload_session_finish. With close=True
+    everything is appended and the session is closed, ready for
+    files_upload_session_finish_batch.
+    The session id and committed offset are saved in
+    upload_sessions_path after every chunk, so when the pi is power
+    cycled mid upload the next boot carries on from that offset.
+    Return (cursor, unsent last chunk).
+    """
+    global chunk_size
+    saved = saved_upload_session(fullname, size, mtime)
+    with upload_source(fullname, source) as f:
+        if saved:
+            print('resuming upload session at byte %d' % saved['offset'])
+            cursor = dropbox.files.UploadSessionCursor(
+                session_id=saved['session_id'], offset=saved['offset'])
+            started_at = saved['started']
+            if saved.get('closed') and close:
+                return cursor, b''
+        else:
+            print('starting upload session')
+            t0 = time.time()
+            data = f.read(chunk_size)
+            last = len(data) >= size
+            started = dbx.files_upload_session_start(data, close=last and close)
+            if data:
+                chunk_size = next_chunk_size(len(data), time.time() - t0)
+            cursor = dropbox.files.UploadSessionCursor(
+                session_id=started.session_id, offset=len(data))
+            started_at = time.time()
+            if last:
+                #whole file went with the start call, the finish sends nothing
+                remember_upload_session(fullname, cursor, size, mtime, started_at, close)
+                return cursor, b''
+        remember_upload_session(fullname, cursor, size, mtime, started_at)
+        while True:
+            f.seek(cursor.offset)
+            data = f.read(chunk_size)
+            last = cursor.offset + len(data) >= size
+            if last and not close:
+                return cursor, data
+            if upload_deadline is not None and time.time() >= upload_deadline:
+                raise BudgetSpent() #offset is saved, the next wake resumes here
+            try:
+                t0 = time.time()
+                dbx.files_upload_session_append_v2(data, cursor, close=last)
+            except dropbox.exceptions.ApiError as err:
+                lookup = session_lookup_error(err)
+                if lookup is None:
+                    raise
+                if lookup.is_incorrect_offset():
+                    #the server got more (or less) than we saved before the power cut
+                    cursor.offset = lookup.get_incorrect_offset().correct_offset
+                    print('server has %d bytes, carrying on from there' % cursor.offset)
+                    remember_upload_session(fullname, cursor, size, mtime, started_at)
+                    continue
+                if saved and (lookup.is_not_found() or lookup.is_closed()):
+                    print('saved upload session is gone, starting again')
+                    forget_upload_session(fullname)
+                    return stage_upload(dbx, fullname, size, mtime, close, source)
+                raise
+            chunk_size = next_chunk_size(len(data), time.time() - t0)
+            cursor.offset += len(data)
+            remember_upload_session(fullname, cursor, size, mtime, started_at, last)
+            print('%d of %d bytes sent, next chunk %d bytes'
+                  % (cursor.offset, size, chunk_size))
+            if last:
+                return cursor, b''
+
+def stage_for_batch(dbx, fullname, path, mode, source=None):
+    """Stage one file in a closed upload session for upload_batch().
+    Return its UploadSessionFinishArg, or None in case of error.
+    """
+    mtime = os.path.getmtime(fullname)
+    size = os.path.getsize(fullname)
+    try:
+        with stopwatch('stage %d bytes' % size):
+            cursor = stage_upload(dbx, fullname, size, mtime, close=True,
+                                  source=source)[0]
+    except dropbox.exceptions.ApiError as err:
+        print('*** API error staging', fullname, err)
+        return None
+    return dropbox.files.UploadSessionFinishArg(
+        cursor=cursor, commit=commit_info(path, mode, mtime))
+
+def upload_batch(dbx, staged, deadline=None):
+    """Commit many staged files at once.
+
+    staged is a list of (fullname, UploadSessionFinishArg) pairs from
+    stage_for_batch(). All sessions are committed with one
+    files_upload_session_finish_batch call and the batch job is polled
+    until dropbox reports the result, or until time.time() passes
+    deadline. A batch not committed by then keeps its closed sessions
+    in upload_sessions_path and its files in the journal, and is
+    committed again on the next wake.
+    Return the list of FileMetadata that were committed.
+    """
+    committed = []
+    for start in range(0, len(staged), finish_batch_max):
+        batch = staged[start:start + finish_batch_max]
+        with stopwatch('finish batch of %d files' % len(batch)):
+            try:
+                result = finish_upload_batch(dbx, [arg for fullname, arg in batch], deadline)
+            except dropbox.exceptions.ApiError as err:
+                print('*** API error committing batch', err)
+                continue
+            except BudgetSpent:
+                print('batch still in progress, it is committed again on the next wake')
+                break
+        for (fullname, arg), entry in zip(batch, result.entries):
+            if entry.is_success():
+                forget_upload_session(fullname)
+                committed.append(entry.get_success())
+                print('uploaded as', entry.get_success().name.encode('utf8'))
+            else:
+                print('*** commit failed for', fullname, entry.get_failure())
+    return committed
+
+def upload_pool(token, jobs, work, workers, byte_budget=0, time_budget=0):
+    """Run work(dbx, job) for every job on a pool of worker threads.
+
+    jobs are tuples starting with the local file name and are handed
+    out in order, so sort them newest first. Each worker has its own
+    Dropbox client so TLS setup and commit latency of one file overlap
+    with the transfer of another. A job is skipped when it would take
+    the run past byte_budget bytes, and no job is started after
+    time_budget seconds; a chunked upload in flight at that point
+    stops after its current chunk and resumes on the next wake.
+    Zero means no budget. Return a list of (job, result) for the jobs
+    that ran. The first unexpected exception of a worker stops the
+    pool and is raised again here.
+    """
+    global upload_deadline
+    todo = Queue.Queue()
+    for job in jobs:
+        todo.put(job)
+    upload_deadline = time.time() + time_budget if time_budget else None
+    lock = threading.Lock()
+    state = {'bytes': 0, 'error': None}
+    done = []
+
+    def worker():
+        dbx = dropbox.Dropbox(token)
+        while state['error'] is None:
+            try:
+                job = todo.get_nowait()
+            except Queue.Empty:
+                return
+            if upload_deadline is not None and time.time() >= upload_deadline:
+                print('time budget spent, leaving the rest for the next wake')
+                return
+            size = os.path.getsize(job[0])
+            with lock:
+                if byte_budget and state['bytes'] + size > byte_budget:
+                    print('byte budget spent, leaving %s for the next wake' % job[0])
+                    continue
+                state['bytes'] += size
+            try:
+                res = work(dbx, job)
+            except BudgetSpent:
+                print('time budget spent during %s, it resumes on the next wake' % job[0])
+                return
+            except Exception:
+                with lock:
+                    if state['error'] is None:
+                        state['error'] = sys.exc_info()
+                return
+            with lock:
+                done.append((job, res))
+
+    with stopwatch('upload pool of %d workers' % workers):
+        threads = [threading.Thread(target=worker) for i in range(max(1, workers))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+    upload_deadline = None
+    if state['error'] is not None:
+        import six
+        six.reraise(*state['error'])
+    print('%d of %d files handled, %d bytes' % (len(done), len(jobs), state['bytes']))
+    return done
+
+def finish_upload_batch(dbx, entries, deadline=None):
+    """Commit staged sessions and wait for the batch job to complete.
+    Raise BudgetSpent when it is not complete after finish_batch_polls
+    polls, or when the next poll would be after deadline.
+    """
+    launch = dbx.files_upload_session_finish_batch(entries)
+    if launch.is_complete():
+        return launch.get_complete()
+    job_id = launch.get_async_job_id()
+    delay = finish_batch_poll_min
+    for poll in range(finish_batch_polls):
+        if deadline is not None and time.time() + delay > deadline:
+            break
+        sleep(delay)
+        status = dbx.files_upload_session_finish_batch_check(job_id)
+        if status.is_complete():
+            return status.get_complete()
+        delay = min(delay * 2, finish_batch_poll_max)
+    raise BudgetSpent()
+
+def session_lookup_error(err):
+    """Return the UploadSessionLookupError inside an append or finish
+    ApiError, or None if the error is about something else.
+    """
+    error = err.error
+    if hasattr(error, 'is_lookup_failed') and error.is_lookup_failed():
+        error = error.get_lookup_failed()
+    if hasattr(error, 'is_incorrect_offset'):
+        return error
+    return None
+
+def load_upload_sessions():
+    try:
+        with open(upload_sessions_path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def saved_upload_session(fullname, size, mtime):
+    """Return the saved session of fullname if it can still be resumed, else None."""
+    saved = load_upload_sessions().get(fullname)
+    if saved is None:
+        return None
+    if saved['size'] != size or saved['mtime'] != mtime:
+        print('file changed since its upload session was saved, starting again')
+        return None
+    if time.time() - saved['started'] > upload_session_lifetime:
+        print('saved upload session is too old to resume, starting again')
+        return None
+    return saved
+
+def remember_upload_session(fullname, cursor, size, mtime, started_at, closed=False):
+    with upload_sessions_lock:
+        sessions = load_upload_sessions()
+        sessions[fullname] = {'session_id': cursor.session_id, 'offset': cursor.offset,
+                              'size': size, 'mtime': mtime, 'started': started_at,
+                              'closed': closed}
+        save_json(upload_sessions_path, sessions)
+
+def forget_upload_session(fullname):
+    with upload_sessions_lock:
+        sessions = load_upload_sessions()
+        if sessions.pop(fullname, None) is not None:
+            save_json(upload_sessions_path, sessions)
+
 def yesno(message, default, args):
     print(message + '? [auto] YES')
     return True
 
 def checkwifi(): #will change the value of hasWifi
+    """Probe the connection until it works or wifi_wait_max seconds
+    have passed, with jittered exponential backoff between tries.
+    Sets hasWifi and probe_latency.
+    """
     global hasWifi
-    for counter in range(1,18):
-        if connectwifi():
+    global probe_latency
+    t0 = time.time()
+    counter = 0
+    while True:
+        counter += 1
+        latency = connectwifi()
+        if latency is not None:
             print('wifi is good, setting has wifi to True')
             hasWifi=True
+            probe_latency = latency
             break
-        elif operationmode and counter>13:
+        waited = time.time() - t0
+        if waited >= wifi_wait_max:
             print('still no wifi, setting hasWifi to false')
             hasWifi=False
             break
-        else:
-            print('no WiFi, waiting for 10 sec then try again, max 2 mins')
-            print("try number:")
-            print(counter)
-            sleep(10)
+        delay = min(wifi_backoff_max, wifi_backoff_first * 2 ** counter)
+        delay = min(random.uniform(delay / 2, delay), wifi_wait_max - waited)
+        print('no WiFi, try number %d, waiting %.1f sec then try again' % (counter, delay))
+        sleep(delay)
 
 def connectwifi():
+    """Layered probe: carrier on wifi_interface, then a default route,
+    then a TCP connect to the dropbox upload endpoint.
+    Return the connect time in seconds, or None when there is no way out.
+    """
     print('checking for wifi conenction')
+    if not link_up(wifi_interface):
+        print('%s has no carrier' % wifi_interface)
+        return None
+    if not has_default_route():
+        print('there is no default route')
+        return None
+    t0 = time.time()
+    try:
+        sock = socket.create_connection((sync_host, 443), timeout=probe_timeout)
+    except socket.error as err: #also covers dns failures and timeouts
+        print('there is no wifi', err)
+        return None
+    latency = time.time() - t0
+    sock.close()
+    print('there is wifi, %d ms to %s' % (latency * 1000, sync_host))
+    return latency
+
+def link_up(interface):
+    """True when the interface has a carrier. A pi without that
+    interface (eg. on ethernet) skips this check.
+    """
+    if not os.path.isdir('/sys/class/net/%s' % interface):
+        return True
+    try:
+        with open('/sys/class/net/%s/carrier' % interface) as f:
+            return f.read().strip() == '1'
+    except IOError: #carrier cannot be read while the interface is down
+        return False
+
+def has_default_route():
+    """True when /proc/net/route has a default route on an interface that is up."""
     try:
-        hehehe=urllib2.urlopen('https://www.google.com',timeout=1)
-        print('there is wifi')
+        with open('/proc/net/route') as f:
+            lines = f.readlines()[1:]
+    except IOError:
         return True
-    except urllib2.URLError as err: pass
-    print('there is no wifi')
+    for line in lines:
+        fields = line.split()
+        #destination 0.0.0.0 with the RTF_UP flag
+        if len(fields) > 3 and fields[1] == '00000000' and int(fields[3], 16) & 1:
+            return True
     return False
 
 def rebootseq():
-    camera.close()
+    wait_for_archive()
+    close_camera()
     GPIO.cleanup()
     print('GPIO has been cleaned, pi is rebooting nowwww')
     #os.system('sudo reboot')
+    import mopiapi
     mopi = mopiapi.mopiapi()
     mopi.setPowerOnDelay(5)
     mopi.setShutdownDelay(5)
 
 def shutdownseq():
-    camera.close()
+    wait_for_archive()
+    close_camera()
     """
     GPIO.output(21,GPIO.HIGH)
     sleep(7) #wait 10seconds then shutdown
@@ -337,34 +1786,30 @@ def shutdownseq():
     GPIO.cleanup()
     print('GPIO has been cleaned, pi is shutting down nowwww')
     #os.system('sudo shutdown now -h')
+    import mopiapi
     mopi = mopiapi.mopiapi()
     mopi.setPowerOnDelay(time_for_wake)
     mopi.setShutdownDelay(5)
 
-def readfiletolines():
-    textf=open(datafile_path,'r')
-    global texts_from_file
-    texts_from_file = textf.readlines()
-    textf.close()
-
-def textValueAdding(value): #value = -1 for rebootadding,-2 for upload
-    global texts_from_file
-    tobeedited=texts_from_file.pop()
-    tobeedited=tobeedited.split(',')
-    tobeedited[value]=" "+str(int(tobeedited[value])+1)+" "
-    tobeedited = ",".join(tobeedited)
-    texts_from_file.append(tobeedited)
-
-def textAddLine(index,name,uploaded):
-    global texts_from_file
-    tobeadded="\n"+str(index)+" , "+name+" , "+str(uploaded)+" , 0 "
-    texts_from_file.append(tobeadded)
-    
-def writetofile():
-    global texts_from_file
-    textf=open(datafile_path,'w')
-    textf.writelines(texts_from_file)
-    textf.close()
+def open_ledger():
+    """Open the picture ledger, filled from the old text datafile the
+    first time. Only the last record is ever read.
+    """
+    global picture_ledger
+    from ledger import Ledger
+    picture_ledger = Ledger(ledger_path)
+    if not len(picture_ledger) and os.path.exists(datafile_path):
+        print('%d lines of the datafile moved to the ledger'
+              % picture_ledger.import_text(datafile_path))
+    return picture_ledger
+
+def ledger_add_reboot():
+    last = picture_ledger.last()
+    picture_ledger.update_last(reboots=min(last.reboots + 1, 255))
+
+def ledger_add_upload():
+    last = picture_ledger.last()
+    picture_ledger.update_last(uploaded=min(last.uploaded + 1, 255))
 
 @contextlib.contextmanager
 def stopwatch(message):
@@ -381,6 +1826,12 @@ def stopwatch(message):
 
 if __name__ == '__main__':
     print('starting mostrap program')
+    if parser.parse_args().calibrate_roi:
+        setupgpio()
+        calibrate_roi()
+        close_camera()
+        GPIO.cleanup()
+        sys.exit(0)
     try:
         print(' setting up gpio')
         setupgpio()
@@ -393,24 +1844,29 @@ if __name__ == '__main__':
     operationcomplete = False
     if operationmode:
         try:
-            readfiletolines()
-            iteminalist=texts_from_file[-1] #reads the last item
-            value_from_last_item=iteminalist.split(',')
-            index_last_item = int(value_from_last_item[0])
-            name_last_item = str(value_from_last_item[1])
-            last_item_uploaded = int(value_from_last_item[2])
-            times_of_reboot = int(value_from_last_item[3])
-            checkwifi() #haswifi will be set inside here
+            last_item = open_ledger().last() #reads the last item only
+            if last_item is None:
+                #a new trap, the first picture is number 1
+                index_last_item, last_item_uploaded, times_of_reboot = 0, 1, 0
+            else:
+                index_last_item = last_item.index
+                last_item_uploaded = last_item.uploaded
+                times_of_reboot = last_item.reboots
+            newpicture = bool(last_item_uploaded) or times_of_reboot > 5
+            #the picture is taken while the wifi is checked, haswifi will be set inside here
+            timings = boot_pipeline(index_last_item+1, newpicture)
+            if newpicture:
+                write_health(index_last_item+1, timings, 0, name_of_picture)
+            else:
+                write_health(index_last_item, timings, times_of_reboot)
             if last_item_uploaded:
                 print 'last item uploaded, proceed with'
-                newpicture=takepicture(index_last_item+1)
                 #takepicture(with index_last_item++) = newpicture
-                textAddLine(index_last_item+1,name_of_picture,0)
+                picture_ledger.append(index_last_item+1,name_of_picture,picture_count,new_arrivals)
             elif times_of_reboot > 5:
                 print 'rebooted too many times, take new picture'
-                newpicture=takepicture(index_last_item+1)
                 #take picture (with index_last_item++) = newpicture
-                textAddLine(index_last_item+1,name_of_picture,0)
+                picture_ledger.append(index_last_item+1,name_of_picture,picture_count,new_arrivals)
             elif not hasWifi:
                 print ' system has to reboot'
                 rebooting = True
@@ -432,14 +1888,14 @@ if __name__ == '__main__':
                 if uploaded or (not rebooting):
                     #write to file
                     if uploaded:
-                        textValueAdding(-2)
-                    writetofile()
+                        ledger_add_upload()
+                    picture_ledger.close()
                     shutdownseq()
                     print 'sys is shutting down'
                 else:
                     #times_of_reboot++, write to file
-                    textValueAdding(-1)
-                    writetofile()
+                    ledger_add_reboot()
+                    picture_ledger.close()
                     rebootseq()
                     print 'rebooting seq for real'
             else:
@@ -448,6 +1904,6 @@ if __name__ == '__main__':
 
     else: ##entering into debug mode
         print('entering debug mode')
-        camera.close()
+        close_camera() #nothing to close unless something used the camera
         print('closing mostrap program and continuing with normal boot')
 
@@ -0,0 +1,212 @@
+"""Recount the mosquitoes in every picture of the archive.
+
+Walks /home/pi/Desktop/mostrap1pics on the pi, or the Dropbox mirror
+of mostraptr_mini on a workstation, and counts every mos*.jpg again
+with mosquitocount.count_mosquitoes(), on a pool of processes.
+Counts are cached by image hash and parameter hash, so running it
+again only counts pictures that changed or were counted with other
+parameters. Prints (or writes with --output) one line per picture:
+index , name , count
+with the index of the picture in the ledger (or the old datafile).
+
+example, after making mosquitoes darker to count:
+python recount_archive.py ~/Dropbox/mostraptr_mini --param darkness=0.3
+"""
+import argparse
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+import ledger
+import mosquitocount
+
+parser = argparse.ArgumentParser(description='Recount the mosquitoes in the whole picture archive')
+parser.add_argument('archive', nargs='?', default='/home/pi/Desktop/mostrap1pics',
+                    help='Folder with the pictures and the ledger')
+parser.add_argument('--datafile', default=None,
+                    help='Ledger or old text datafile giving the picture indexes '
+                         '(default: the ledger in the archive, else its datafile)')
+parser.add_argument('--cache', default=None,
+                    help='Count cache (default: .recountcache in the archive)')
+parser.add_argument('--param', action='append', default=[], metavar='NAME=VALUE',
+                    help='Change one of mosquitocount.default_params, can be repeated')
+parser.add_argument('--processes', type=int, default=0,
+                    help='Worker processes, 0 for one per core')
+parser.add_argument('--chunksize', type=int, default=4,
+                    help='Pictures handed to a worker at a time')
+parser.add_argument('--output', default=None,
+                    help='Write the table to this file instead of printing it')
+
+picture_name = re.compile(r'^mos.*\.jpg$')
+ledger_time_name = re.compile(r'^mos(\d+)mos(.+)\.jpg$') #saved on disk as mos<time>.jpg
+index_name = re.compile(r'^mos(\d+)(-\d+)?\.jpg$') #mos<index>.jpg or a burst frame mos<index>-<k>.jpg
+thumbnail_dir = 'thumbs' #1/8 scale copies for marginal links, named like the pictures
+
+def parse_params(settings):
+    """default_params with the NAME=VALUE settings applied."""
+    changes = {}
+    for setting in settings:
+        name, value = setting.split('=', 1)
+        default = getattr(mosquitocount.default_params, name)
+        changes[name] = type(default)(value)
+    return mosquitocount.default_params._replace(**changes)
+
+def params_hash(params):
+    return hashlib.sha1(json.dumps(params._asdict(), sort_keys=True).encode('utf8')).hexdigest()
+
+def ledger_names(path):
+    """(index, name) of every picture in a ledger or a text datafile."""
+    if ledger.is_ledger(path):
+        with ledger.Ledger(path, readonly=True) as records:
+            return [(record.index, record.name) for record in records
+                    if record.name] #empty when only the luminance was kept
+    with open(path, 'r') as f:
+        lines = f.readlines()
+    names = []
+    for line in lines:
+        fields = [field.strip() for field in line.split(',')]
+        if len(fields) >= 4 and fields[0].isdigit():
+            names.append((int(fields[0]), fields[1]))
+    return names
+
+def read_ledger(path):
+    """Map picture file names on disk to their index in the ledger."""
+    indexes = {}
+    try:
+        names = ledger_names(path)
+    except IOError:
+        print('no ledger at %s, indexes come from the file names' % path)
+        return indexes
+    for index, name in names:
+        match = ledger_time_name.match(name)
+        if match:
+            name = 'mos%s.jpg' % match.group(2)
+        indexes[name] = index
+    return indexes
+
+def picture_index(name, indexes):
+    if name in indexes:
+        return indexes[name]
+    root, ext = os.path.splitext(name)
+    base = re.sub(r'-\d+$', '', root) + ext #burst frames share the index of their picture
+    if base in indexes:
+        return indexes[base]
+    match = index_name.match(name)
+    return int(match.group(1)) if match else None
+
+def find_pictures(archive):
+    for dn, dirs, files in os.walk(archive):
+        dirs[:] = [d for d in dirs if not d.startswith('.') and d != thumbnail_dir]
+        for name in sorted(files):
+            if picture_name.match(name):
+                yield os.path.join(dn, name)
+
+def load_cache(path):
+    try:
+        with open(path, 'r') as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = {}
+    cache.setdefault('files', {}) #path -> [size, mtime, image hash]
+    cache.setdefault('counts', {}) #image hash:params hash -> count
+    return cache
+
+def save_cache(path, cache):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(cache, f)
+    os.rename(tmp, path)
+
+_worker = {} #params and hashes already counted, set by _init_worker()
+
+def _init_worker(params, phash, known):
+    _worker['params'] = params
+    _worker['phash'] = phash
+    _worker['known'] = known
+
+def _recount(fullname):
+    """Hash a picture and count it unless that hash is already counted.
+    The file is read once, for both. Return (fullname, hash, count or None).
+    """
+    with open(fullname, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    if digest in _worker['known']:
+        return fullname, digest, None
+    y = mosquitocount.read_luma(io.BytesIO(data))
+    return fullname, digest, mosquitocount.count_mosquitoes(y, _worker['params'])[0]
+
+def recount(archive, datafile, cache_path, params, processes, chunksize):
+    """Return the table rows (index, name, count) for every picture in archive."""
+    phash = params_hash(params)
+    cache = load_cache(cache_path)
+    indexes = read_ledger(datafile)
+    results = {}
+    todo = []
+    for fullname in find_pictures(archive):
+        st = os.stat(fullname)
+        known = cache['files'].get(fullname)
+        if known is not None and known[:2] == [st.st_size, st.st_mtime]:
+            key = '%s:%s' % (known[2], phash)
+            if key in cache['counts']:
+                results[fullname] = cache['counts'][key]
+                continue
+        todo.append(fullname)
+    print('%d pictures cached, %d to hash or count' % (len(results), len(todo)))
+    if todo:
+        t0 = time.time()
+        known = frozenset(key.split(':')[0] for key in cache['counts']
+                          if key.endswith(':' + phash))
+        pool = multiprocessing.Pool(processes or multiprocessing.cpu_count(),
+                                    _init_worker, (params, phash, known))
+        try:
+            for done, (fullname, digest, count) in enumerate(
+                    pool.imap_unordered(_recount, todo, chunksize), 1):
+                key = '%s:%s' % (digest, phash)
+                if count is not None:
+                    cache['counts'][key] = count
+                st = os.stat(fullname)
+                cache['files'][fullname] = [st.st_size, st.st_mtime, digest]
+                results[fullname] = cache['counts'][key]
+                if done % 100 == 0:
+                    print('%d of %d done, %.1f pictures per second'
+                          % (done, len(todo), done / (time.time() - t0)))
+                    save_cache(cache_path, cache) #a long run keeps its progress
+        finally:
+            pool.close()
+            pool.join()
+        save_cache(cache_path, cache)
+    rows = []
+    for fullname, count in results.items():
+        name = os.path.basename(fullname)
+        rows.append((picture_index(name, indexes), name, count))
+    rows.sort(key=lambda row: (row[0] is None, row[0], row[1]))
+    return rows
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    archive = os.path.expanduser(args.archive)
+    if not os.path.isdir(archive):
+        print('%s is not a folder on your filesystem' % archive)
+        sys.exit(1)
+    params = parse_params(args.param)
+    print('counting with %s' % (params,))
+    datafile = args.datafile or os.path.join(archive, 'ledger')
+    if not os.path.exists(datafile):
+        datafile = os.path.join(archive, 'datafile')
+    rows = recount(archive, datafile,
+                   args.cache or os.path.join(archive, '.recountcache'),
+                   params, args.processes, args.chunksize)
+    lines = ['%s , %s , %d\n' % ('-' if index is None else index, name, count)
+             for index, name, count in rows]
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.writelines(lines)
+        print('%d pictures written to %s' % (len(lines), args.output))
+    else:
+        sys.stdout.writelines(lines)
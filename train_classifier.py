@@ -0,0 +1,189 @@
+"""Train the blob classifier of mosquitocount.py, on a workstation.
+
+The counting stage also keeps debris, flies and glare of about the
+right size and shape. The classifier is a second stage scoring every
+blob from mosquitocount.blob_features(); it is trained here over
+labelled blobs of the archive (or the Dropbox mirror) and saved as a
+small .npz that the pi loads from classifier_path.
+
+1. list the blobs of the pictures, one line per blob:
+python train_classifier.py detect ~/Dropbox/mostraptr_mini labels.txt
+2. replace the ? at the end of each line by 1 for a mosquito, 0 for
+anything else; lines left at ? are not used
+3. train, a linear model with --hidden 0, else one hidden layer:
+python train_classifier.py train ~/Dropbox/mostraptr_mini labels.txt --output mosquito_classifier.npz
+4. copy mosquito_classifier.npz to /home/pi/Desktop on the pi
+"""
+import argparse
+import os
+import sys
+
+import numpy
+
+import mosquitocount
+
+parser = argparse.ArgumentParser(description='Train the mosquito blob classifier')
+parser.add_argument('mode', choices=['detect', 'train'],
+                    help='detect lists the blobs to label, train fits the model on the labels')
+parser.add_argument('archive', help='Folder with the pictures')
+parser.add_argument('labels', help='Label file, written by detect and read by train')
+parser.add_argument('--output', default='mosquito_classifier.npz', help='Model file written by train')
+parser.add_argument('--hidden', type=int, default=16, help='Hidden units, 0 for a linear model')
+parser.add_argument('--steps', type=int, default=2000, help='Gradient steps')
+parser.add_argument('--rate', type=float, default=0.01, help='Learning rate')
+parser.add_argument('--l2', type=float, default=1e-3, help='Weight decay')
+parser.add_argument('--validation', type=float, default=0.2,
+                    help='Fraction of the pictures held out to pick the threshold and report accuracy')
+parser.add_argument('--match', type=float, default=5.0,
+                    help='Pixels between a label and the blob it belongs to')
+parser.add_argument('--seed', type=int, default=0)
+
+thumbnail_dir = 'thumbs' #1/8 scale copies for marginal links, named like the pictures
+
+def pictures(archive):
+    for dn, dirs, files in os.walk(archive):
+        dirs[:] = [d for d in dirs if not d.startswith('.') and d != thumbnail_dir]
+        for name in sorted(files):
+            if name.startswith('mos') and name.endswith('.jpg'):
+                yield os.path.relpath(os.path.join(dn, name), archive)
+
+def detect(archive, labels):
+    """Write name , cx , cy , ? for every blob the counting stage keeps."""
+    lines = 0
+    with open(labels, 'w') as f:
+        for name in pictures(archive):
+            y = mosquitocount.read_luma(os.path.join(archive, name))
+            blobs = mosquitocount.count_mosquitoes(y)[1]
+            for cx, cy in zip(blobs['cx'], blobs['cy']):
+                f.write('%s , %.1f , %.1f , ?\n' % (name, cx, cy))
+                lines += 1
+    print('%d blobs to label in %s' % (lines, labels))
+
+def read_labels(path):
+    """{picture name: [(cx, cy, label)]} of the lines labelled 0 or 1."""
+    labelled = {}
+    with open(path, 'r') as f:
+        for line in f:
+            fields = [field.strip() for field in line.split(',')]
+            if len(fields) != 4 or fields[3] not in ('0', '1'):
+                continue
+            labelled.setdefault(fields[0], []).append(
+                (float(fields[1]), float(fields[2]), int(fields[3])))
+    return labelled
+
+def labelled_features(archive, labelled, match):
+    """Features of the blob under every label, and the picture each
+    came from. Labels without a blob within match pixels are skipped.
+    """
+    features, targets, groups = [], [], []
+    missed = 0
+    for group, (name, points) in enumerate(sorted(labelled.items())):
+        y = mosquitocount.read_luma(os.path.join(archive, name))
+        blobs = mosquitocount.count_mosquitoes(y)[1]
+        if not len(blobs['area']):
+            missed += len(points)
+            continue
+        rows = mosquitocount.blob_features(y, blobs)
+        for cx, cy, label in points:
+            dist = (blobs['cx'] - cx) ** 2 + (blobs['cy'] - cy) ** 2
+            nearest = int(numpy.argmin(dist))
+            if dist[nearest] > match * match:
+                missed += 1
+                continue
+            features.append(rows[nearest])
+            targets.append(label)
+            groups.append(group)
+    if missed:
+        print('%d labels had no blob near them, the counting parameters changed?' % missed)
+    return numpy.array(features), numpy.array(targets, dtype=numpy.float64), numpy.array(groups)
+
+def init_layers(sizes, rng):
+    return [(rng.randn(n_in, n_out) * numpy.sqrt(2.0 / n_in), numpy.zeros(n_out))
+            for n_in, n_out in zip(sizes[:-1], sizes[1:])]
+
+def forward(layers, x):
+    """Activations of every layer, the last one the logit."""
+    outputs = [x]
+    for k, (w, b) in enumerate(layers):
+        z = outputs[-1].dot(w) + b
+        outputs.append(z if k == len(layers) - 1 else numpy.maximum(z, 0))
+    return outputs
+
+def train(x, t, hidden, steps, rate, l2, seed):
+    """Full batch Adam on the class balanced cross entropy."""
+    rng = numpy.random.RandomState(seed)
+    sizes = [x.shape[1]] + ([hidden] if hidden else []) + [1]
+    layers = init_layers(sizes, rng)
+    weight = numpy.where(t == 1, 0.5 / max(t.mean(), 1e-6), 0.5 / max(1 - t.mean(), 1e-6))
+    moments = [[numpy.zeros_like(p) for p in layer + layer] for layer in layers]
+    for step in range(1, steps + 1):
+        outputs = forward(layers, x)
+        p = 1 / (1 + numpy.exp(-numpy.clip(outputs[-1].ravel(), -30, 30)))
+        grad = ((p - t) * weight / len(t))[:, None]
+        for k in range(len(layers) - 1, -1, -1):
+            w, b = layers[k]
+            grads = (outputs[k].T.dot(grad) + l2 * w, grad.sum(axis=0))
+            grad = grad.dot(w.T) * (outputs[k] > 0)
+            m = moments[k]
+            updated = []
+            for j, (param, g) in enumerate(zip((w, b), grads)):
+                m[j] = 0.9 * m[j] + 0.1 * g
+                m[j + 2] = 0.999 * m[j + 2] + 0.001 * g * g
+                mhat = m[j] / (1 - 0.9 ** step)
+                vhat = m[j + 2] / (1 - 0.999 ** step)
+                updated.append(param - rate * mhat / (numpy.sqrt(vhat) + 1e-8))
+            layers[k] = tuple(updated)
+    return layers
+
+def probabilities(layers, x):
+    return 1 / (1 + numpy.exp(-numpy.clip(forward(layers, x)[-1].ravel(), -30, 30)))
+
+def best_threshold(p, t):
+    """Threshold with the best balanced accuracy."""
+    best, best_score = 0.5, -1
+    for threshold in numpy.linspace(0.05, 0.95, 19):
+        score = balanced_accuracy(p >= threshold, t)
+        if score > best_score:
+            best, best_score = threshold, score
+    return best
+
+def balanced_accuracy(predicted, t):
+    positive = t == 1
+    recall = (predicted & positive).sum() / float(max(positive.sum(), 1))
+    specificity = (~predicted & ~positive).sum() / float(max((~positive).sum(), 1))
+    return (recall + specificity) / 2
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.mode == 'detect':
+        detect(args.archive, args.labels)
+        sys.exit(0)
+    labelled = read_labels(args.labels)
+    x, t, groups = labelled_features(args.archive, labelled, args.match)
+    if len(t) == 0 or t.min() == t.max():
+        print('need labelled mosquitoes (1) and other blobs (0) to train')
+        sys.exit(1)
+    print('%d blobs from %d pictures, %d mosquitoes' % (len(t), len(labelled), int(t.sum())))
+    mean = x.mean(axis=0)
+    scale = x.std(axis=0) + 1e-6
+    xs = (x - mean) / scale
+    #whole pictures are held out, blobs of one picture look alike
+    rng = numpy.random.RandomState(args.seed)
+    held = rng.rand(groups.max() + 1) < args.validation
+    valid = held[groups]
+    if valid.all() or not valid.any() or t[~valid].min() == t[~valid].max():
+        valid = numpy.zeros(len(t), dtype=bool)
+    layers = train(xs[~valid], t[~valid], args.hidden, args.steps, args.rate, args.l2, args.seed)
+    check = valid if valid.any() else ~valid
+    p = probabilities(layers, xs[check])
+    threshold = best_threshold(p, t[check])
+    print('%s balanced accuracy %.3f at threshold %.2f'
+          % ('validation' if valid.any() else 'training (too few pictures to hold out)',
+             balanced_accuracy(p >= threshold, t[check]), threshold))
+    model = {'mean': mean.astype(numpy.float32), 'scale': scale.astype(numpy.float32),
+             'threshold': numpy.array(threshold)}
+    for k, (w, b) in enumerate(layers):
+        model['w%d' % k] = w.astype(numpy.float32)
+        model['b%d' % k] = b.astype(numpy.float32)
+    numpy.savez_compressed(args.output, **model)
+    print('model saved to %s, %d bytes' % (args.output, os.path.getsize(args.output)))